@@ -5,22 +5,26 @@ import array
 import json
 import hashlib
 import itertools
+import datetime
 import glob
 import gzip
-import http.client as httpc
 import os
 import io
+import re
+import queue
+import lzma
 import shutil
 import signal
 import struct
 import sys
-import urllib.parse
-import textwrap
-import traceback
+import threading
 import time
 import zlib
 
-from collections import defaultdict
+from collections import defaultdict, deque
+
+# The network stack, thread pools, ctypes and the like are imported in the functions that need them,
+# so that reading and writing alarmfiles (e.g. in short-lived worker processes) stays cheap to import.
 
 ALARM_VERSION = '0.1'
 ALARMFILE_MAGIC = b'0\x9e\xb9\x08'
@@ -44,10 +48,12 @@ def request_stop_handler(signal, frame):
         print('Caught interrupt, waiting for current operation to finish (press again to exit immediately)')
 
 class limit:
-    core_left    = 0
-    core_reset   = 0
-    search_left  = 0
-    search_reset = 0
+    core_left     = 0
+    core_reset    = 0
+    search_left   = 0
+    search_reset  = 0
+    graphql_left  = 0
+    graphql_reset = 0
 
 def has_api_left(num_core, num_search):
     t = time.time()
@@ -55,6 +61,239 @@ def has_api_left(num_core, num_search):
     se = limit.search_left >= num_search or limit.search_reset < t
     return co and se
 
+PROFILE_NAME = 'profile.json'
+PROFILE_TOP = 10 # number of repositories (and functions) listed in the report
+PROFILE_MODES = ('timers', 'cprofile', 'memory')
+
+global_profiler = None
+
+# Exclusive timers for the stages of acquisition (see --profile), a stage pauses the one it starts
+# in. Optionally, each repository runs under cProfile and tracemalloc.
+class Profiler:
+    def __init__(self, modes):
+        for i in modes:
+            if i not in PROFILE_MODES:
+                die('Unknown profiling mode %s, must be one of %s' % (i, ', '.join(PROFILE_MODES)))
+        self.cprofile = None
+        self.do_cprofile = 'cprofile' in modes
+        self.tracemalloc = None
+        if 'memory' in modes:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+        
+        # Only the thread acquiring the repositories is timed, others (e.g. the crawler of cmd_small)
+        # would mess up the stack
+        self.thread = threading.get_ident()
+        self.stack = []
+        self.t_last = 0
+        self.stages = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.repos = []
+
+    def push(self, stage):
+        if threading.get_ident() != self.thread: return
+        t = time.perf_counter()
+        if self.stack:
+            self.stages[self.stack[-1]] += t - self.t_last
+        self.stack.append(stage)
+        self.t_last = t
+
+    def pop(self):
+        if threading.get_ident() != self.thread: return
+        t = time.perf_counter()
+        stage = self.stack.pop()
+        self.stages[stage] += t - self.t_last
+        self.calls[stage] += 1
+        self.t_last = t
+
+    def _flush(self):
+        for k, v in self.stages.items():
+            self.totals[k] += v
+        self.stages.clear()
+        self.calls.clear()
+
+    def begin_repo(self):
+        self._flush()
+        self.stack.clear()
+        self.time_start = time.perf_counter()
+        if self.tracemalloc is not None:
+            self.tracemalloc.reset_peak()
+        if self.do_cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def end_repo(self, owner, repo, **info):
+        total = time.perf_counter() - self.time_start
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.stack.clear()
+        
+        stages = dict(self.stages)
+        stages['other'] = max(total - sum(stages.values()), 0)
+        entry = {'repo': '%s/%s' % (owner, repo), 'total': total, 'stages': stages,
+            'calls': dict(self.calls)}
+        entry.update(info)
+        if self.tracemalloc is not None:
+            entry['peak_memory'] = self.tracemalloc.get_traced_memory()[1]
+        if self.cprofile is not None:
+            import pstats
+            st = pstats.Stats(self.cprofile).stats
+            top = sorted(st.items(), key=lambda i: -i[1][2])[:PROFILE_TOP]
+            entry['functions'] = [('%s:%d(%s)' % func, tt, nc) for func, (_, nc, tt, _, _) in top]
+            self.cprofile = None
+        self.repos.append(entry)
+        self.stages['other'] = stages['other']
+        self._flush()
+
+    def report(self, fname):
+        self._flush()
+        total = sum(self.totals.values())
+        print('Time by stage (%.1fs in total):' % (total,))
+        for k, v in sorted(self.totals.items(), key=lambda i: -i[1]):
+            print('  %-14s %8.2fs %5.1f%%' % (k, v, v / max(total, 1e-9) * 100))
+
+        print('Slowest repositories:')
+        for i in sorted(self.repos, key=lambda i: -i['total'])[:PROFILE_TOP]:
+            stage = max(i['stages'], key=i['stages'].get)
+            print('  %-40s %8.2fs (mostly %s, %.2fs)' % (i['repo'], i['total'], stage,
+                i['stages'][stage]))
+            for func, tt, nc in i.get('functions', ())[:3]:
+                print('      %8.2fs %8d calls  %s' % (tt, nc, func))
+        if self.tracemalloc is not None:
+            print('Repositories using the most memory:')
+            for i in sorted(self.repos, key=lambda i: -i['peak_memory'])[:PROFILE_TOP]:
+                print('  %-40s %8.1f MiB' % (i['repo'], i['peak_memory'] / 2**20))
+
+        with open(fname, 'w') as f:
+            f.write(json.dumps({'totals': self.totals, 'repos': sorted(self.repos,
+                key=lambda i: -i['total'])}, indent=4))
+        print('Profile written to %s' % (fname,))
+
+# Times a stage if profiling is enabled, hot paths check global_profiler themselves
+class profile_stage:
+    __slots__ = ['stage']
+
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        if global_profiler is not None:
+            global_profiler.push(self.stage)
+
+    def __exit__(self, *exc):
+        if global_profiler is not None:
+            global_profiler.pop()
+
+# Idle connections that are kept for reuse, by host. Only in daemon mode (see cmd_daemon), else
+# connections are closed after use.
+global_connections = None
+
+# Give the connection back via release
+def connect(host):
+    import http.client as httpc
+
+    if global_connections is not None and global_connections.get(host):
+        return global_connections[host].pop()
+    conn = httpc.HTTPSConnection(host)
+    conn.key = host
+    conn.reused = False
+    return conn
+
+# Keeps the connection if it is idle, i.e. the last response has been read completely
+def release(conn, idle=True):
+    if global_connections is not None and idle and conn.sock is not None:
+        conn.reused = True
+        global_connections.setdefault(conn.key, []).append(conn)
+    else:
+        conn.close()
+
+# A kept connection may have been closed by the server in the meantime, then we try once more
+def request(conn, method, url, **kwargs):
+    import http.client as httpc
+
+    if getattr(conn, 'reused', False):
+        conn.reused = False
+        try:
+            conn.request(method, url, **kwargs)
+            return conn.getresponse()
+        except (httpc.HTTPException, ConnectionError):
+            conn.close() # reconnects on the next request
+    conn.request(method, url, **kwargs)
+    return conn.getresponse()
+
+GOVERNOR_STATE_NAME = 'governor.state'
+GOVERNOR_SLOT_NAME = '%s.slot%d'
+GOVERNOR_STATE = struct.Struct('<dd') # time of the last update, tokens left (may be negative)
+GOVERNOR_BURST = 0.5 # seconds at the full rate that may be used at once
+GOVERNOR_POLL = 0.2  # seconds between attempts to get a slot
+GOVERNOR_CHUNK = 65536 # bytes read from the network at once
+
+global_governor = None
+
+# Limits bandwidth and concurrent fetches of the alarm processes sharing path (see Governor format
+# in the README)
+class Governor:
+    def __init__(self, path, rate, max_fetches):
+        import fcntl
+        self.fcntl = fcntl
+        
+        self.path = path
+        self.rate = rate
+        self.max_fetches = max_fetches
+        if not os.path.isdir(path):
+            print('%s does not exist, will be created' % (path,))
+            os.makedirs(path)
+        self.fd = os.open(os.path.join(path, GOVERNOR_STATE_NAME), os.O_RDWR | os.O_CREAT, 0o666)
+
+    # Waits for a free slot for host, slots are released when their process dies
+    def acquire(self, host):
+        waiting = False
+        while True:
+            for i in range(self.max_fetches):
+                f = open(os.path.join(self.path, GOVERNOR_SLOT_NAME % (host, i)), 'a')
+                try:
+                    self.fcntl.flock(f, self.fcntl.LOCK_EX | self.fcntl.LOCK_NB)
+                except OSError:
+                    f.close()
+                    continue
+                return f
+            if not waiting:
+                print('Waiting for one of %d fetches from %s to finish... ' % (self.max_fetches, host),
+                      end='')
+                sys.stdout.flush()
+                waiting = True
+            with profile_stage('throttle'):
+                time.sleep(GOVERNOR_POLL)
+
+    def release(self, slot):
+        slot.close() # also releases the lock
+
+    # Takes num bytes out of the bucket, sleeping while it is in debt
+    def charge(self, num):
+        if not self.rate: return
+        burst = self.rate * GOVERNOR_BURST
+        self.fcntl.flock(self.fd, self.fcntl.LOCK_EX)
+        try:
+            t = time.time()
+            data = os.pread(self.fd, GOVERNOR_STATE.size, 0)
+            last, tokens = GOVERNOR_STATE.unpack(data) if len(data) == GOVERNOR_STATE.size else (t, burst)
+            tokens = min(burst, tokens + max(t - last, 0) * self.rate) - num
+            os.pwrite(self.fd, GOVERNOR_STATE.pack(t, tokens), 0)
+        finally:
+            self.fcntl.flock(self.fd, self.fcntl.LOCK_UN)
+        if tokens < 0:
+            with profile_stage('throttle'):
+                time.sleep(-tokens / self.rate)
+
+def open_governor():
+    if not options.governor:
+        return None
+    return Governor(os.path.join(options.data, options.governor), options.max_rate * 1024,
+        options.max_fetches)
+
 def init_github_api():
     global global_api_token
     if not os.path.exists(options.token_file):
@@ -64,16 +303,18 @@ def init_github_api():
     with open(options.token_file, 'r') as f:
         global_api_token = f.read().strip()
     
-    conn = httpc.HTTPSConnection(GITHUB_API_BASE)
+    conn = connect(GITHUB_API_BASE)
     try:
         data = get_from_api(conn, '/rate_limit')
     finally:
-        conn.close()
+        release(conn)
     
     limit.core_left    = data['resources']['core']['remaining']
     limit.core_reset   = data['resources']['core']['reset']
     limit.search_left  = data['resources']['search']['remaining']
     limit.search_reset = data['resources']['search']['reset']
+    limit.graphql_left  = data['resources']['graphql']['remaining']
+    limit.graphql_reset = data['resources']['graphql']['reset']
 
 def get_from_api(conn, url):
     
@@ -88,21 +329,240 @@ def get_from_api(conn, url):
     
     if left == 0 and dur > 0:
         print('No api requests remaining, sleeping for %.0fs' % dur)
-        time.sleep(dur)
+        with profile_stage('rate_limit'):
+            time.sleep(dur)
     
-    conn.request('GET', url, headers=h)
-    r = conn.getresponse()
+    with profile_stage('api'):
+        r = request(conn, 'GET', url, headers=h)
 
-    if is_core_req:
-        limit.core_left    = int(r.getheader('X-RateLimit-Remaining'))
-        limit.core_reset   = int(r.getheader('X-RateLimit-Reset')) + 2
-    else:
-        limit.search_left  = int(r.getheader('X-RateLimit-Remaining'))
-        limit.search_reset = int(r.getheader('X-RateLimit-Reset')) + 2
+        if is_core_req:
+            limit.core_left    = int(r.getheader('X-RateLimit-Remaining'))
+            limit.core_reset   = int(r.getheader('X-RateLimit-Reset')) + 2
+        else:
+            limit.search_left  = int(r.getheader('X-RateLimit-Remaining'))
+            limit.search_reset = int(r.getheader('X-RateLimit-Reset')) + 2
     
-    return json.loads(r.read().decode('utf-8'))
+        return json.loads(r.read().decode('utf-8'))
+
+def post_to_graphql(conn, query):
+    h = {'User-Agent': options.user_agent, 'Content-Type': 'application/json',
+         'Authorization': 'bearer ' + global_api_token }
+
+    dur = limit.graphql_reset - time.time()
+    if limit.graphql_left == 0 and dur > 0:
+        print('No graphql requests remaining, sleeping for %.0fs' % dur)
+        with profile_stage('rate_limit'):
+            time.sleep(dur)
+
+    with profile_stage('api'):
+        r = request(conn, 'POST', '/graphql', body=json.dumps({'query': query}).encode('utf-8'),
+            headers=h)
+
+        limit.graphql_left  = int(r.getheader('X-RateLimit-Remaining'))
+        limit.graphql_reset = int(r.getheader('X-RateLimit-Reset')) + 2
+
+        return json.loads(r.read().decode('utf-8'))
+
+# Maps (owner, repo) -> set of root trees, as prefetched by prefetch_trees
+global_prefetched_trees = {}
+# Maps (owner, repo) -> size on disk in bytes, as reported by the API (also from prefetch_trees)
+global_repo_sizes = {}
+# Maps (owner, repo) -> (owner, repo) of the parent, or None if it is not a fork (see repo_parent)
+global_repo_parents = {}
+
+def prefetch_trees(repos):
+    # This gets the root trees of the tips of up to --prefetch-batch repositories in a single graphql
+    # query, which would need two core api requests per repository otherwise.
+    num = options.prefetch_batch
+    MAX_BRANCHES = options.files_max_refs
+    repos = [i for i in repos if i not in global_prefetched_trees]
+    if not num or not repos: return
+    import traceback
+
+    frag = '''fragment Tips on Repository {
+        diskUsage
+        parent { nameWithOwner }
+        defaultBranchRef { target { ... on Commit { tree { oid } } } }
+        refs(refPrefix: "refs/heads/", first: %d) { nodes { target { ... on Commit { tree { oid } } } } }
+    }''' % (MAX_BRANCHES,)
+    
+    conn = connect(GITHUB_API_BASE)
+    try:
+        for k in range(0, len(repos), num):
+            if global_stop_flag: break
+            batch = repos[k:k+num]
+            
+            print('Prefetching tree information for %d repositories... ' % (len(batch),), end='')
+            sys.stdout.flush()
+            
+            query = 'query {\n%s\n}\n%s' % ('\n'.join(
+                'r%d: repository(owner: %s, name: %s) { ...Tips }' % (i, json.dumps(owner), json.dumps(repo))
+                for i, (owner, repo) in enumerate(batch)), frag)
+            result = post_to_graphql(conn, query)
+            data = result.get('data')
+            if data is None:
+                # Leave the batch out, so that get_some_files uses the core api
+                print('Error: %s' % (result.get('errors') or result,))
+                continue
+            
+            for i, (owner, repo) in enumerate(batch):
+                alias = 'r%d' % (i,)
+                if alias not in data:
+                    continue
+                d = data[alias]
+                if d is None:
+                    # Not found, getting the files will fail anyways
+                    global_prefetched_trees[owner, repo] = set()
+                    continue
+                
+                if d.get('diskUsage') is not None:
+                    global_repo_sizes[owner, repo] = d['diskUsage'] * 1024
+                parent = d.get('parent')
+                global_repo_parents[owner, repo] = tuple(parent['nameWithOwner'].split('/')) if parent else None
+                
+                tips = [d['defaultBranchRef']] if d['defaultBranchRef'] else []
+                tips += d['refs']['nodes']
+                trees = []
+                for t in tips:
+                    if t['target'] and 'tree' in t['target'] and t['target']['tree']['oid'] not in trees:
+                        trees.append(t['target']['tree']['oid'])
+                global_prefetched_trees[owner, repo] = set(trees[:MAX_BRANCHES])
+            print('Done.')
+    except:
+        # Not critical, we just fall back to the core api
+        print('Error.')
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        release(conn)
+
+PLANNER_STATE_NAME = 'planner.json'
+PLANNER_STATE_VERSION = 2
+HAVE_LINE_SIZE = 50 # b'0032have <sha>\n'
+ACK_LINE_SIZE = 56  # b'0038ACK <sha> common\n'
+
+# Until enough acquisitions have been observed, the estimates of the planner are drawn towards these
+PLANNER_PRIOR_BYTES = 2**26
+PLANNER_PRIOR_RATIO = 0.5     # bytes saved on the wire per byte of blobs offered as haves
+PLANNER_PRIOR_FRACTION = 0.25 # bytes saved on the wire per byte of repository size
+
+# The planner used by fetch_pack, set during acquire_metadata
+global_planner = None
+
+# Decides which blobs to offer as haves, and whether the API requests to find them are worth it
+# (see Planner format in the README)
+class Have_planner:
+    def __init__(self, fname):
+        self.fname = fname
+        self.state = None
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                self.state = json.loads(f.read())
+            if self.state.get('version') != PLANNER_STATE_VERSION:
+                # Savings were measured differently, start over
+                self.state = None
+        if self.state is None:
+            # Sums over all acquisitions where the size of the repository was known
+            self.state = {'version': PLANNER_STATE_VERSION, 'repos': 0, 'size': 0, 'offered': 0,
+                'saved': 0}
+
+        # Totals for this session
+        self.api = 0
+        self.negotiation = 0
+        self.saved = 0
+
+    def save(self):
+        fname_tmp = self.fname + '.tmp'
+        with open(fname_tmp, 'w') as f:
+            f.write(json.dumps(self.state))
+        os.replace(fname_tmp, self.fname)
+
+    def ratio(self):
+        s = self.state
+        return (s['saved'] + PLANNER_PRIOR_RATIO * PLANNER_PRIOR_BYTES) / (s['offered'] + PLANNER_PRIOR_BYTES)
+
+    def fraction(self):
+        s = self.state
+        return (s['saved'] + PLANNER_PRIOR_FRACTION * PLANNER_PRIOR_BYTES) / (s['size'] + PLANNER_PRIOR_BYTES)
+
+    # Whether the expected saving for the repository justifies num_api API requests
+    def worth_api(self, owner, repo, num_api):
+        size = global_repo_sizes.get((owner, repo))
+        if size is None or not options.min_saving:
+            return True
+        return size * self.fraction() >= num_api * options.min_saving * 1024
+
+    # files is a list of (size, sha), biggest first
+    def plan(self, files):
+        r = self.ratio()
+        lst = list(itertools.takewhile(lambda i: i[0] * r > HAVE_LINE_SIZE + ACK_LINE_SIZE,
+            files[:options.files_max_num]))
+        if files:
+            print('Offering %d of %d files as haves (expected to save %.1f MiB)' % (len(lst),
+                len(files), sum(i[0] for i in lst) * r / 2**20))
+        return lst
+
+    # offered and saved are the sizes of the blobs sent as haves and acknowledged by the server
+    def record(self, owner, repo, offered, saved, negotiation):
+        self.negotiation += negotiation
+        size = global_repo_sizes.get((owner, repo))
+        if size is None or not offered:
+            return
+
+        s = self.state
+        s['repos'] += 1
+        s['size'] += size
+        s['offered'] += offered
+        s['saved'] += saved
+        self.saved += saved
+        print('Haves saved about %.1f MiB of %.1f MiB offered (repository has %.1f MiB)'
+            % (saved / 2**20, offered / 2**20, size / 2**20))
+
+    def report(self):
+        if not self.api and not self.negotiation: return
+        print('Haves saved about %.1f MiB in total, for %d API requests and %.1f KiB of negotiation'
+              % (self.saved / 2**20, self.api, self.negotiation / 2**10))
+        if self.api:
+            print('That is %.1f KiB per API request' % (self.saved / 2**10 / self.api,))
+
+# The repository owner/repo has been forked from, or None
+def repo_parent(owner, repo):
+    if (owner, repo) in global_repo_parents:
+        return global_repo_parents[owner, repo]
+    if not has_api_left(1, 0):
+        return None
+    
+    import traceback
+    conn = connect(GITHUB_API_BASE)
+    try:
+        data = get_from_api(conn, '/repos/%s/%s' % (owner, repo))
+        parent = data.get('parent')
+        global_repo_parents[owner, repo] = tuple(parent['full_name'].split('/')) if parent else None
+    except:
+        # Then we do not know, which is fine
+        traceback.print_exc(file=sys.stderr)
+        return None
+    finally:
+        release(conn)
+    return global_repo_parents[owner, repo]
+
+# Tips of the parent of a fork in the object store. Only those acquired with a selection that
+# includes ours, else the server would leave out trees we do not have.
+def fork_haves(store, owner, repo, max_depth):
+    if not store.has_tips():
+        return []
+    parent = repo_parent(owner, repo)
+    if parent is None:
+        return []
+    tips, parent_depth = store.tips(parent)
+    if parent_depth is not None and (max_depth is None or parent_depth < max_depth):
+        return []
+    haves = [i.encode('ascii') for i in tips if bytes.fromhex(i) in store]
+    if haves:
+        print('Fork of %s/%s, offering %d of its tips as haves' % (parent + (len(haves),)))
+    return haves
 
 def get_some_files_hide_errors(owner, repo):
+    import traceback
     try:
         return get_some_files(owner, repo)
     except:
@@ -110,43 +570,52 @@ def get_some_files_hide_errors(owner, repo):
         traceback.print_exc(file=sys.stderr)
         return []
 
+# Blobs in the trees of some refs, as list of (size, sha), biggest first
 def get_some_files(owner, repo):
     MAX_BRANCHES = options.files_max_refs
 
-    if not has_api_left(1 + 2*MAX_BRANCHES, 0):
+    trees = global_prefetched_trees.pop((owner, repo), None)
+    num_api = 1 + 2*MAX_BRANCHES if trees is None else len(trees)
+    
+    if not has_api_left(num_api, 0):
         print('Downloading tree information skipped, no api limit left')
         return []
+    if global_planner is not None:
+        if not global_planner.worth_api(owner, repo, num_api):
+            print('Downloading tree information skipped, repository is too small')
+            return []
+        global_planner.api += num_api
     
     print('Downloading tree information... ', end='')
     sys.stdout.flush()
     
-    conn = httpc.HTTPSConnection(GITHUB_API_BASE)
+    conn = connect(GITHUB_API_BASE)
     try:
-        data = get_from_api(conn, '/repos/%s/%s/git/refs' % (owner, repo))
-        commits = {i['object']['sha'] for i in data[:MAX_BRANCHES]}
-        loc = '/repos/%s/%s/git/commits/%s'
-        trees = {get_from_api(conn, loc % (owner, repo, i))['tree']['sha'] for i in commits}
+        if trees is None:
+            data = get_from_api(conn, '/repos/%s/%s/git/refs' % (owner, repo))
+            commits = {i['object']['sha'] for i in data[:MAX_BRANCHES]}
+            loc = '/repos/%s/%s/git/commits/%s'
+            trees = {get_from_api(conn, loc % (owner, repo, i))['tree']['sha'] for i in commits}
 
         files = set()
         for t in trees:
             data = get_from_api(conn, '/repos/%s/%s/git/trees/%s?recursive=1' % (owner, repo, t))
             files.update((-j['size'], j['sha']) for j in data['tree'] if j['type'] == 'blob')
 
-        conn.close()
-
         # Biggest files first
-        files = list(files)
-        files.sort()
-        files = [sha for _, sha in files]
+        files = [(-size, sha) for size, sha in sorted(files)]
 
         print('Done.')
         print('Found %d files' % len(files))
 
         return files
     finally:
-        conn.close()
+        release(conn)
 
 def get_top100_for_language(lang):
+    import http.client as httpc
+    import urllib.parse
+
     print('Querying top100 repositories for %s... ' % lang, end='')
     sys.stdout.flush()
     
@@ -161,43 +630,169 @@ def get_top100_for_language(lang):
     finally:
         conn.close()
 
-global_sector_max_stars = {}
-
-def get_small_repos(page):
-    # page starts with one, due to GitHub API sillyness
-    print('Querying small repositories, page %d... ' % page, end='')
-    sys.stdout.flush()
-
-    conn = httpc.HTTPSConnection(GITHUB_API_BASE)
-    try:
-        sector = (page - 1) // GITHUB_MAX_PAGES
-        page = page - sector * GITHUB_MAX_PAGES
-        data = get_small_repos_helper(sector, page, conn)
-        print('Done.')
-        return data
-    finally:
-        conn.close()
+def search_repositories(conn, q, page):
+    import urllib.parse
+    params = urllib.parse.urlencode({'q': q, 'sort': 'stars', 'per_page': 100, 'page': page})
+    return get_from_api(conn, '/search/repositories?%s' % params)
+
+# The search API returns at most this many results for a query
+GITHUB_MAX_RESULTS = GITHUB_MAX_PAGES * 100
+GITHUB_FIRST_DAY = datetime.date(2008, 1, 1).toordinal()
+SMALL_CHECKPOINT_NAME = 'small.checkpoint'
+SMALL_CRAWL_THREADS = 4 # partitions that are counted or paged through at the same time
+
+# Finds small repositories via the search API, in partitions by size and creation date of at most
+# GITHUB_MAX_RESULTS each. The main thread acquires them in batches of one page.
+class Small_crawler:
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queue = queue.Queue(maxsize=4)
+        self.counting = [] # partitions in todo that a thread is counting right now
+        self.failed = False
+
+        params = [options.small_min, options.small_max]
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                self.state = json.loads(f.read())
+            if self.state['params'] != params:
+                die('Checkpoint %s was created with different size limits %s, remove it to restart'
+                    % (fname, self.state['params']))
+            print('Resuming from checkpoint %s' % (fname,))
+        else:
+            today = datetime.date.today().toordinal()
+            self.state = {
+                'params': params,
+                'todo': [params + [GITHUB_FIRST_DAY, today]], # partitions that need to be counted
+                'parts': [], # partitions with at most GITHUB_MAX_RESULTS results
+                'batch': 0,
+            }
+            self.save()
+        # First finish the partitions we already started on
+        self.resume = list(self.state['parts'])
+
+    def save(self):
+        with self.lock:
+            fname_tmp = self.fname + '.tmp'
+            with open(fname_tmp, 'w') as f:
+                f.write(json.dumps(self.state))
+            os.replace(fname_tmp, self.fname)
+
+    @staticmethod
+    def query(p):
+        size_lo, size_hi, day_lo, day_hi = p
+        day_lo = datetime.date.fromordinal(day_lo).isoformat()
+        day_hi = datetime.date.fromordinal(day_hi).isoformat()
+        return 'size:%d..%d created:%s..%s' % (size_lo, size_hi, day_lo, day_hi)
+
+    @staticmethod
+    def split(p):
+        size_lo, size_hi, day_lo, day_hi = p
+        if day_lo < day_hi:
+            mid = (day_lo + day_hi) // 2
+            return [[size_lo, size_hi, day_lo, mid], [size_lo, size_hi, mid + 1, day_hi]]
+        elif size_lo < size_hi:
+            mid = (size_lo + size_hi) // 2
+            return [[size_lo, mid, day_lo, day_hi], [mid + 1, size_hi, day_lo, day_hi]]
+        else:
+            return None
 
-def get_small_repos_helper(sector, page, conn):
-    if sector == 0:
-        q_suf = ''
-    else:
-        if sector not in global_sector_max_stars:
-            get_small_repos_helper(sector - 1, GITHUB_MAX_PAGES, conn)
-        max_stars = global_sector_max_stars[sector]
-        q_suf = ' stars:<=%d' % (max_stars,)
+    def run(self):
+        threads = [threading.Thread(target=self._worker, daemon=True)
+            for _ in range(SMALL_CRAWL_THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.queue.put(None)
+
+    def _next(self):
+        # Returns (part, None) for a partition to page through, (None, p) for one to count, or
+        # None if there is nothing left. Called with the lock held.
+        while not global_stop_flag and not self.failed:
+            if self.resume:
+                return self.resume.pop(), None
+            todo = [i for i in self.state['todo'] if i not in self.counting]
+            if todo:
+                self.counting.append(todo[-1])
+                return None, todo[-1]
+            if not self.counting:
+                return None
+            # The partitions being counted may still be split
+            self.cond.wait()
+        return None
+
+    def _worker(self):
+        import http.client as httpc
+        import traceback
         
-    mm = options.small_min, options.small_max, q_suf
-    params = urllib.parse.urlencode({
-        'q': 'size:%d..%d%s' % mm, 'sort': 'stars', 'per_page': 100, 'page': page
-    })
-    data = get_from_api(conn, '/search/repositories?%s' % params)
+        conn = httpc.HTTPSConnection(GITHUB_API_BASE)
+        p = None
+        try:
+            while True:
+                with self.lock:
+                    item = self._next()
+                if item is None: break
+                part, p = item
+                if part is not None:
+                    self._crawl(conn, part, None)
+                    continue
+                    
+                # The first page also tells us the number of results, so we do not waste a request
+                data = search_repositories(conn, self.query(p), 1)
+                total = data['total_count']
+                lst = self.split(p) if total > GITHUB_MAX_RESULTS else None
+                if total > GITHUB_MAX_RESULTS and lst is None:
+                    print('Warning: Query %s has %d results, only the first %d can be retrieved'
+                          % (self.query(p), total, GITHUB_MAX_RESULTS))
+
+                with self.lock:
+                    self.state['todo'].remove(p)
+                    self.counting.remove(p)
+                    if lst is not None:
+                        self.state['todo'] += lst[::-1]
+                        part = None
+                    else:
+                        part = {'p': p, 'total': min(total, GITHUB_MAX_RESULTS), 'page': 0}
+                        self.state['parts'].append(part)
+                    p = None
+                    self.cond.notify_all()
+                self.save()
+                
+                if part is not None:
+                    self._crawl(conn, part, data)
+        except:
+            print('Error while searching for repositories.')
+            traceback.print_exc(file=sys.stderr)
+            with self.lock:
+                # The partition stays in todo, for the next run
+                if p is not None:
+                    self.counting.remove(p)
+                self.failed = True
+                self.cond.notify_all()
+        finally:
+            conn.close()
 
-    if page == GITHUB_MAX_PAGES:
-        global_sector_max_stars[sector+1] = int(data['items'][-1]['stargazers_count'])
+    def _crawl(self, conn, part, first):
+        pages = (part['total'] + 99) // 100
+        for page in range(part['page'] + 1, pages + 1):
+            if global_stop_flag: break
+            if page == 1 and first is not None:
+                data = first
+            else:
+                data = search_repositories(conn, self.query(part['p']), page)
+            repos = [(i['owner']['login'], i['name']) for i in data['items']]
+            print('Found %d small repositories (%s, page %d/%d)'
+                  % (len(repos), self.query(part['p']), page, pages))
+            self.queue.put((part, page, repos))
+
+    def done(self, part, page):
+        with self.lock:
+            part['page'] = page
+            self.state['batch'] += 1
+        self.save()
 
-    return [(i['owner']['login'], i['name']) for i in data['items']]
-            
 def pkt_line(data):
     i = 0
     while i < len(data):
@@ -209,15 +804,24 @@ def pkt_line(data):
             yield data[i+4:i+l]
             i += l
 
-def mk_pkt_line(lst):
-    data = b''
+def iter_pkt_line(lst, chunk_size=65536):
+    # Encodes the lines and yields them in chunks of about chunk_size bytes, for use as a streamed
+    # request body
+    data = bytearray()
     for i in lst:
         if i is None:
             data += b'0000'
         else:
             data += b'%04x' % (len(i) + 4)
             data += i
-    return data
+        if len(data) >= chunk_size:
+            yield bytes(data)
+            data.clear()
+    if data:
+        yield bytes(data)
+
+def mk_pkt_line(lst):
+    return b''.join(iter_pkt_line(lst))
 
 def shorten(s, maxlen=80):
     return s if len(s) <= maxlen else s[:maxlen-3] + b'...'
@@ -230,6 +834,7 @@ class ObjType:
     OBJ_TREE = 2
     OBJ_BLOB = 3
     OBJ_TAG = 4
+    OBJ_STORE_REF = 5 # alarm extension, the object lives in the object store
     OBJ_OFS_DELTA = 6
     OBJ_REF_DELTA = 7
 
@@ -269,6 +874,41 @@ class Commit:
         return (b'Commit(tree=%s, parents=[%s])' % (self.tree[:HASH_DETAIL], b', '.join(
             i[:HASH_DETAIL] for i in self.parents))).decode('utf-8')
 
+IDENT_TIME_MAX = 2**63 - 1 # the columns of commitfiles are i64 timestamps ...
+IDENT_TZ_MAX = 2**15 - 1   # ... and i16 timezone offsets
+
+def parse_ident(b):
+    # "Name <email> 1234567890 +0200" -> (b'Name <email>', 1234567890, 120)
+    l = b.rsplit(b' ', 2)
+    try:
+        tz = int(l[2])
+        tz = (-1 if tz < 0 else 1) * (abs(tz) // 100 * 60 + abs(tz) % 100)
+        t = int(l[1])
+        if abs(t) > IDENT_TIME_MAX or abs(tz) > IDENT_TZ_MAX:
+            raise ValueError
+        return bytes(l[0]), t, tz
+    except (IndexError, ValueError):
+        # Some old repositories have broken dates, just keep the identity then
+        return bytes(b), 0, 0
+
+# Like Commit, but also parses author and committer (timezones in minutes)
+class Commit_meta(Commit):
+    __slots__ = ['author', 'author_time', 'author_tz', 'committer', 'committer_time', 'committer_tz']
+    
+    @classmethod
+    def parse(cls, b, do_blob):
+        self = super().parse(b, do_blob)
+        self.author, self.author_time, self.author_tz = b'', 0, 0
+        self.committer, self.committer_time, self.committer_tz = b'', 0, 0
+
+        end = b.find(b'\n\n')
+        for line in (b[:end] if end != -1 else b).split(b'\n'):
+            if line.startswith(b'author '):
+                self.author, self.author_time, self.author_tz = parse_ident(line[7:])
+            elif line.startswith(b'committer '):
+                self.committer, self.committer_time, self.committer_tz = parse_ident(line[10:])
+        return self
+
 class Tree:
     typ = ObjType.OBJ_TREE
     __slots__ = ['blob', 'entries']
@@ -295,6 +935,62 @@ class Tree:
         return (b'Tree(entries=[\n  %s\n])' % b',\n  '.join(b'(%s, %s, %s)' % 
             (i[0], i[2][:HASH_DETAIL], i[1]) for i in self.entries)).decode('utf-8')
 
+TREE_MODES = (b'40000', b'100644', b'100755', b'120000', b'160000') # the ones git writes
+TREE_ENTRY = re.compile(rb'([0-7]+) ([^\0]*)\0(.{20})', re.S)
+
+# Interns the names and modes of tree entries, the modes in TREE_MODES come first
+class Tree_dictionary:
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        self.modes = list(TREE_MODES)
+        self.mode_ids = {j: i for i, j in enumerate(TREE_MODES)}
+
+    def add_name(self, name):
+        i = self.name_ids[name] = len(self.names)
+        self.names.append(name)
+        return i
+
+    def add_mode(self, mode):
+        i = self.mode_ids[mode] = len(self.modes)
+        self.modes.append(mode)
+        return i
+
+global_tree_dictionary = Tree_dictionary()
+
+# Like Tree, but the entries are columns of ids into global_tree_dictionary and raw hashes, about
+# 30 bytes per entry instead of 200. Pass it via the classes argument of parse_pack.
+class Tree_columns:
+    typ = ObjType.OBJ_TREE
+    __slots__ = ['blob', 'name_id', 'mode_id', 'shas']
+
+    @classmethod
+    def parse(cls, b, do_blob):
+        self = cls()
+        if do_blob:
+            self.blob = b
+        l = TREE_ENTRY.findall(b)
+        if sum(len(mode) + len(name) for mode, name, _ in l) + 22 * len(l) != len(b):
+            raise Pack_error('Malformed tree')
+        
+        d = global_tree_dictionary
+        ids = d.name_ids
+        self.name_id = array.array('I', [ids[i] if i in ids else d.add_name(i) for _, i, _ in l])
+        ids = d.mode_ids
+        self.mode_id = array.array('I', [ids[i] if i in ids else d.add_mode(i) for i, _, _ in l])
+        self.shas = b''.join(i for _, _, i in l)
+        return self
+
+    def __len__(self):
+        return len(self.name_id)
+
+    @property
+    def entries(self):
+        # The same as for Tree, for code that does not care about memory
+        d = global_tree_dictionary
+        return [(d.modes[self.mode_id[i]], d.names[self.name_id[i]], self.shas[20*i:20*i+20].hex()
+            .encode('ascii')) for i in range(len(self.name_id))]
+
 class Blob:
     __slots__ = ['blob']
     
@@ -307,7 +1003,7 @@ class Blob:
         
 def get_typ(i):
     return ['OBJ_NONE', 'OBJ_COMMIT', 'OBJ_TREE', 'OBJ_BLOB',
-            'OBJ_TAG', None, 'OBJ_OFS_DELTA', 'OBJ_REF_DELTA'][i]
+            'OBJ_TAG', 'OBJ_STORE_REF', 'OBJ_OFS_DELTA', 'OBJ_REF_DELTA'][i]
 
 def objhead(b, off = 0):
     typ = (b[off] >> 4) & 7
@@ -318,6 +1014,17 @@ def objhead(b, off = 0):
         size |= (b[off + i] & 127) << (i*7 - 3)
     return typ, size, off+i+1
 
+def mk_objhead(typ, size):
+    data = bytearray()
+    b = (typ << 4) | (size & 15)
+    size >>= 4
+    while size:
+        data.append(b | 128)
+        b = size & 127
+        size >>= 7
+    data.append(b)
+    return data
+
 
 # translation of patch-delta.c:patch_delta
 def patch_delta(src, delta):
@@ -372,38 +1079,105 @@ def patch_delta(src, delta):
     
     return dst
 
+class Remote_error(Exception): pass
+
+# Raised for malformed packs and alarmfiles. These are not asserts, so that they are still checked
+# when running with -O (see cmd_verify).
+class Pack_error(Exception): pass
+
+# Channel 1 is returned by readinto, 2 is parsed into progress, 3 raises Remote_error
 class Side_band_64k:
+    CHUNK_SIZE = 256 * 1024 # must be larger than the maximum packet size of 65520
+
+    _progress_re = re.compile(rb'([A-Za-z ]+):\s+\d+% \((\d+)/(\d+)\)')
+    _total_re = re.compile(rb'([a-z-]+) (\d+)')
+    
     def __init__(self, fd):
         self.fd = fd
-        self.left = 0
-
+        self.buf = bytearray(self.CHUNK_SIZE)
+        self.start = self.end = 0
+        self.left = 0 # bytes left in the current packet of channel 1
+        self.eof = False
+        self.nbytes = 0 # bytes read from fd
+        self.progress = {}
+        self.progress_buf = b'' # messages may be split across packets
+        self.conn = None # if set, the connection is released on close
+        self.governor = None # if set, reads are charged to it, and the slot is released on close
+        self.slot = None
+
+    def _fill(self, num):
+        # Make sure that there are at least num bytes in the buffer, returns whether that worked
+        if self.end - self.start >= num:
+            return True
+        self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+        self.end -= self.start
+        self.start = 0
+        m = memoryview(self.buf)
+        # Everyone sharing a governor reads in pieces of the same size, so that they get equal turns
+        step = GOVERNOR_CHUNK if self.governor is not None else len(m)
+        prof = global_profiler
+        while self.end < num:
+            if prof is not None: prof.push('network')
+            i = self.fd.readinto(m[self.end:self.end+step])
+            if prof is not None: prof.pop()
+            if not i: return False
+            self.end += i
+            self.nbytes += i
+            if self.governor is not None:
+                self.governor.charge(i)
+        return True
+
+    def _handle_progress(self, data):
+        lines = re.split(rb'[\r\n]', self.progress_buf + data)
+        self.progress_buf = lines.pop()
+        for line in lines:
+            m = self._progress_re.match(line)
+            if m:
+                self.progress[m.group(1).decode('utf-8', 'replace').strip()] = (int(m.group(2)),
+                    int(m.group(3)))
+            elif line.startswith(b'Total '):
+                # Total 1234 (delta 56), reused 78 (delta 9), pack-reused 10
+                for k, v in self._total_re.findall(line.replace(b'Total', b'total')):
+                    self.progress.setdefault(k.decode('ascii'), int(v))
+    
     def readinto(self, buf):
         m = memoryview(buf)
-
-        m1, m2 = m[:self.left], m[self.left:]
-        num = self.fd.readinto(m1)
-        assert num == len(m1)
-        self.left -= len(m1)
-        if not m2: return num
-        assert not self.left
+        num = 0
         
-        while True:
-            b = self.fd.read(4)
-            if not b: break
-            size = int(b, 16)
-            if not size: break
-            stream = self.fd.read(1)[0]
-            size -= 5
+        while num < len(m):
+            if self.left:
+                if self.start == self.end and not self._fill(1):
+                    raise Remote_error('Connection closed in the middle of a packet')
+                n = min(self.left, self.end - self.start, len(m) - num)
+                m[num:num+n] = self.buf[self.start:self.start+n]
+                num += n
+                self.start += n
+                self.left -= n
+                continue
+            
+            if self.eof or not self._fill(4):
+                break
+            size = int(self.buf[self.start:self.start+4], 16)
+            if not size:
+                # Flush packet, end of the stream
+                self.start += 4
+                self.eof = True
+                break
+            
+            if not self._fill(size):
+                raise Remote_error('Connection closed in the middle of a packet')
+            stream = self.buf[self.start+4]
             if stream == 1:
-                m1, m2 = m2[:size], m2[size:]
-                assert self.fd.readinto(m1) == len(m1)
-                num += len(m1)
-                self.left += size - len(m1)
-                if not m2: return num
-                assert not self.left
-            elif stream == 2:
-                self.fd.read(size)
-        
+                self.left = size - 5
+                self.start += 5
+            else:
+                data = bytes(self.buf[self.start+5:self.start+size])
+                self.start += size
+                if stream == 2:
+                    self._handle_progress(data)
+                elif stream == 3:
+                    raise Remote_error('Remote error: %s' % (data.decode('utf-8', 'replace').strip(),))
+                
         return num
 
     def read(self, num):
@@ -412,13 +1186,23 @@ class Side_band_64k:
         return buf[:num]
 
     def close(self):
+        # The connection can be reused only if the response has been read completely
+        idle = self.eof and not self.fd.read()
         self.fd.close()
+        if self.conn is not None:
+            release(self.conn, idle)
+        if self.slot is not None:
+            self.governor.release(self.slot)
+            self.slot = None
     
 global_64k_buffer = bytearray(64*1024)
 
 MAX_HEADER_SIZE = 256
     
-def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=True):
+def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=True, store=None,
+               classes=None, max_depth=None):
+    # If max_depth is given, only the trees less than max_depth below the root tree of a commit are
+    # yielded (see select_depth)
     buf = memoryview(global_64k_buffer)
     class num: pass
 
@@ -427,13 +1211,20 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
     num.trees   = 0
     num.rbytes  = 0
 
-    time_last = time.clock()
+    time_last = time.perf_counter()
 
     blobstore = {}
     typestore = {}
     offsstore = {}
+    prof = global_profiler
+
+    tree_depth = {}    # sha -> smallest known depth of the tree
+    tree_pending = {}  # sha -> data of the trees whose depth is not known yet
+    tree_subtrees = {} # sha -> subtrees of the trees that have been yielded
         
-    if do_parse:
+    if classes is not None:
+        cls_commit, cls_tree = classes
+    elif do_parse:
         cls_commit = Commit
         cls_tree   = Tree
     else:
@@ -449,19 +1240,22 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
         return start + i + 1, x
     
     def skip(start, end, offset):
+        if prof is not None: prof.push('inflate')
         while True:
             o.decompress(buf[start:end])
             if o.eof: break
             start = 0
             end = f.readinto(buf)
             num.rbytes += end
-            assert end
+            if not end: raise Pack_error('Unexpected end of pack')
         start = end - len(o.unused_data)
         num.skipped += 1
         offsstore[offset] = None
+        if prof is not None: prof.pop()
         return start, end
     
     def read(start, end):
+        if prof is not None: prof.push('inflate')
         data = bytearray()
         while True:
             data += o.decompress(buf[start:end])
@@ -469,28 +1263,71 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
             start = 0
             end = f.readinto(buf)
             num.rbytes += end
-            assert end
+            if not end: raise Pack_error('Unexpected end of pack')
         start = end - len(o.unused_data)
+        if prof is not None: prof.pop()
         return start, end, data
 
-    def handle(typ, data, offset):
+    def hash_object(typ, data, offset):
         # see sha1_file.c:write_sha1_file_prepare
+        if prof is not None: prof.push('hash')
         h = hashlib.sha1()
         h.update(b'%s %d\0' % (ObjType.typename(typ), len(data)))
         h.update(data)
         sha = h.digest().hex().encode('ascii')
+        if prof is not None: prof.pop()
         if do_blobs:
             blobstore[sha] = data
             typestore[sha] = typ
             offsstore[offset] = sha
+        return sha
+
+    def handle(typ, data, offset):
+        yield from dispatch(typ, data, hash_object(typ, data, offset))
+
+    def dispatch(typ, data, sha):
+        if max_depth is None:
+            yield parse_object(typ, data, sha)
+        elif typ == ObjType.OBJ_COMMIT:
+            yield parse_object(typ, data, sha)
+            yield from set_depth(bytes(data[5:45]), 0) # the commit starts with 'tree <sha>\n'
+        elif sha in tree_depth:
+            yield from keep_tree(sha, data)
+        else:
+            # Trees usually come after the one containing them, but not always (e.g. delta bases)
+            tree_pending[sha] = data
+
+    def set_depth(sha, depth):
+        if depth >= tree_depth.get(sha, max_depth): return
+        tree_depth[sha] = depth
+        if sha in tree_pending:
+            yield from keep_tree(sha, tree_pending.pop(sha))
+        elif sha in tree_subtrees:
+            # Already yielded further down, its subtrees may be in reach now
+            for i in tree_subtrees[sha]:
+                yield from set_depth(i, depth + 1)
+
+    def keep_tree(sha, data):
+        sha, obj = parse_object(ObjType.OBJ_TREE, data, sha)
+        yield sha, obj
+        entries = obj.entries if isinstance(obj, Tree) else Tree.parse(data, False).entries
+        tree_subtrees[sha] = [i[2] for i in entries if i[0] == b'40000']
+        for i in tree_subtrees[sha]:
+            yield from set_depth(i, tree_depth[sha] + 1)
+
+    def parse_object(typ, data, sha):
         if typ == ObjType.OBJ_COMMIT:
             num.commits += 1
-            return sha, cls_commit.parse(data, do_blobs)
+            if prof is not None: prof.push('parse_commit')
+            obj = cls_commit.parse(data, do_blobs)
         elif typ == ObjType.OBJ_TREE:
             num.trees += 1
-            return sha, cls_tree.parse(data, do_blobs)
+            if prof is not None: prof.push('parse_tree')
+            obj = cls_tree.parse(data, do_blobs)
         else:
             assert False
+        if prof is not None: prof.pop()
+        return sha, obj
 
     start = 0
     if stream_state is None:
@@ -499,7 +1336,8 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
         start, end, _ = stream_state
         end += f.readinto(buf[end:])
 
-    assert buf[start:start+8] == b'PACK\0\0\0\2'
+    if buf[start:start+8] != b'PACK\0\0\0\2':
+        raise Pack_error('Not a pack, or unsupported version')
     start += 8
     num.total  = int.from_bytes(buf[start:start+4], byteorder='big')
     num.left   = num.total
@@ -511,8 +1349,8 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
     
     num.rbytes += end
     while num.left is None or num.left > 0:
-        if start == 0 and time.clock() > time_last + 3:
-            time_last = time.clock()
+        if start == 0 and time.perf_counter() > time_last + 3:
+            time_last = time.perf_counter()
             if num.left is not None:
                 print('Downloading... (%d/%d)' % (num.total - num.left, num.total))
             else:
@@ -529,11 +1367,13 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
         if   typ == ObjType.OBJ_NONE:
             # Compatibility with our own metadata stream
             break
-        elif typ in (ObjType.OBJ_COMMIT, ObjType.OBJ_TREE):
+        elif typ == ObjType.OBJ_COMMIT or (typ == ObjType.OBJ_TREE and max_depth != 0):
             start, end, data = read(start, end)
-            assert len(data) == size
-            yield handle(typ, data, offset)
-        elif typ in (ObjType.OBJ_BLOB, ObjType.OBJ_TAG):
+            if len(data) != size:
+                raise Pack_error('Object at offset %d has size %d instead of %d' % (offset, len(data), size))
+            yield from handle(typ, data, offset)
+        elif typ in (ObjType.OBJ_TREE, ObjType.OBJ_BLOB, ObjType.OBJ_TAG):
+            # Deltas against skipped objects are skipped as well
             start, end = skip(start, end, offset)
         elif typ == ObjType.OBJ_OFS_DELTA:
             start, offset_rel = varint(start)
@@ -543,20 +1383,42 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
                 start, end = skip(start, end, offset)
             else:
                 start, end, data = read(start, end)
+                if prof is not None: prof.push('patch_delta')
                 data = patch_delta(blobstore[sha_base], data)
-                yield handle(typestore[sha_base], data, offset)
+                if prof is not None: prof.pop()
+                yield from handle(typestore[sha_base], data, offset)
+        elif typ == ObjType.OBJ_STORE_REF:
+            if store is None:
+                raise Pack_error('Stream references the object store, but none was given')
+            if size != 20:
+                raise Pack_error('Reference at offset %d has size %d' % (offset, size))
+            sha_ref = buf[start:start+20].hex().encode('ascii')
+            typ, data = store.get(buf[start:start+20].tobytes())
+            start += 20
+            sha = hash_object(typ, data, offset)
+            if sha != sha_ref:
+                raise Pack_error('Object %s in the object store has hash %s' % (sha_ref.decode('ascii'),
+                    sha.decode('ascii')))
+            yield from dispatch(typ, data, sha)
         elif typ == ObjType.OBJ_REF_DELTA:
-            sha_base = buf[start:start+20].hex()
+            sha_base = buf[start:start+20].hex().encode('ascii')
+            if sha_base not in blobstore and store is not None and do_blobs:
+                # In a thin pack, the base may be an object we have from another repository
+                sha_bin = buf[start:start+20].tobytes()
+                if sha_bin in store:
+                    typestore[sha_base], blobstore[sha_base] = store.get(sha_bin)
             start += 20
 
             if sha_base not in blobstore:
                 start, end = skip(start, end, offset)
             else:
                 start, end, data = read(start, end)
+                if prof is not None: prof.push('patch_delta')
                 data = patch_delta(blobstore[sha_base], data)
-                yield handle(typestore[sha_base], data, offset)
+                if prof is not None: prof.pop()
+                yield from handle(typestore[sha_base], data, offset)
         else:
-            assert False
+            raise Pack_error('Unknown object type %d at offset %d' % (typ, offset))
 
         if num.left is not None:
             num.left -= 1
@@ -582,10 +1444,12 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
 
     if stream_state is None:
         # Skip the SHA1 checksum
-        assert end - start == 20
+        if end - start != 20:
+            raise Pack_error('Pack checksum is missing')
     else:
         # This should hold, as we are parsing a metadata stream
-        assert buf[start:start+20] == b'\0'*20
+        if buf[start:start+20] != b'\0'*20:
+            raise Pack_error('Metadata stream does not end with 20 zero bytes')
         start += 20
         stream_state[0] = start
         stream_state[1] = end
@@ -593,7 +1457,7 @@ def parse_pack(f, do_parse=True, do_summary=True, stream_state=None, do_blobs=Tr
 
     if do_summary:
         print('Commits: %d\nTrees:   %d\nSkipped: %d\nTotal:   %d'
-              % (num.commits, num.trees, num.skipped, num.total))
+              % (num.commits, num.trees, num.skipped + len(tree_pending), num.total))
     
 def dump(fname, r):
     with open(fname, 'wb') as f:
@@ -604,19 +1468,119 @@ def dump(fname, r):
         f.flush()
         f.close()
 
-def fetch_pack(owner, repo):
-    files = get_some_files_hide_errors(owner, repo)[:options.files_max_num]
+NEGOTIATION_FIRST_BATCH = 256
+NEGOTIATION_MAX_BATCH = 4096
+
+def upload_pack_request(wants, caps, haves, done, filter_spec=None):
+    yield b'want %s %s' % (wants[0], caps)
+    for i in wants[1:]:
+        yield b'want %s\n' % (i,)
+    if filter_spec is not None:
+        yield b'filter %s\n' % (filter_spec,)
+    yield None
+    for i in haves:
+        yield b'have %s\n' % (i,)
+    yield b'done\n' if done else None
+
+# Returns (common, final), the haves the server acknowledged and whether the pack follows
+def read_acks(r, done):
+    common = []
+    while True:
+        b = r.read(4)
+        if not b:
+            # A round without done ends after the NAK, unless the server is ready (see no-done)
+            assert not done
+            return common, False
+        num = int(b, 16)
+        assert num != 0
+        line = r.read(num - 4).rstrip(b'\n')
+        l = line.split(b' ')
+        assert len(l) in (1, 2, 3)
+        if l[0] == b'NAK':
+            if done: return common, True
+            continue
+        assert l[0] == b'ACK'
+        if len(l) == 2: return common, True
+        if l[2] == b'common':
+            common.append(l[1])
+
+# Stateless negotiation in up to --negotiation-rounds requests. Returns the response, the bytes
+# used for haves and acknowledgements, and the set of acknowledged haves.
+def negotiate(conn, url, headers, wants, caps, haves, filter_spec=None):
+    common = []
+    common_set = set()
+    i = 0
+    batch = NEGOTIATION_FIRST_BATCH
+    rounds = 0
+    nbytes = 0
+    
+    while rounds < options.negotiation_rounds - 1 and i < len(haves):
+        lst = common + haves[i:i+batch]
+        body = iter_pkt_line(upload_pack_request(wants, caps, lst, False, filter_spec))
+        conn.request('POST', url, headers=headers, body=body, encode_chunked=True)
+        r = conn.getresponse()
+        acks, final = read_acks(r, False)
+        nbytes += HAVE_LINE_SIZE * len(lst) + ACK_LINE_SIZE * len(acks)
+        for j in acks:
+            if j not in common_set:
+                common_set.add(j)
+                common.append(j)
+        rounds += 1
+        i += batch
+        batch = min(2*batch, NEGOTIATION_MAX_BATCH)
+        if final: break
+    else:
+        lst = common + haves[i:]
+        body = iter_pkt_line(upload_pack_request(wants, caps, lst, True, filter_spec))
+        conn.request('POST', url, headers=headers, body=body, encode_chunked=True)
+        r = conn.getresponse()
+        acks, _ = read_acks(r, True)
+        nbytes += HAVE_LINE_SIZE * len(lst) + ACK_LINE_SIZE * len(acks)
+        common_set.update(acks)
+        rounds += 1
+
+    if rounds > 1:
+        print('(%d rounds, %d of %d haves in common) ' % (rounds, len(common), min(i, len(haves))),
+              end='')
+    return r, nbytes, common_set
+
+# (ref, tip) of the advertised refs matching the patterns, annotated tags are peeled
+def select_refs(lines, patterns):
+    import fnmatch
+    patterns = patterns.split(',')
+    result = {}
+    for line in lines:
+        sha, name = line.rstrip(b'\n').split(b' ', 1)
+        name = name.decode('utf-8', 'replace')
+        if name.endswith('^{}'):
+            # The peeled value comes right after the tag
+            name = name[:-3]
+        if any(fnmatch.fnmatchcase(name, i) for i in patterns):
+            result[name] = sha
+    return list(result.items())
+
+def fetch_pack(owner, repo, shared=()):
+    # shared are commits (hex) the repository shares with one we have, they are offered as haves
+    files = get_some_files_hide_errors(owner, repo)
+    if global_planner is not None:
+        files = global_planner.plan(files)
+    else:
+        files = files[:options.files_max_num]
 
     h = {'User-Agent': options.user_agent}
 
     print('Starting pack negotiation... ', end='')
     sys.stdout.flush()
-    
-    conn = httpc.HTTPSConnection('github.com')
+
+    slot = global_governor.acquire('github.com') if global_governor is not None else None
+    conn = connect('github.com')
     try:
-        conn.request('GET', '/%s/%s.git/info/refs?service=git-upload-pack' % (owner, repo), headers=h)
-        data = conn.getresponse().read()
+        data = request(conn, 'GET', '/%s/%s.git/info/refs?service=git-upload-pack' % (owner, repo),
+            headers=h).read()
         if data.startswith(b'Repo'):
+            release(conn)
+            if slot is not None:
+                global_governor.release(slot)
             return None
         it = pkt_line(data)
         assert next(it).rstrip(b'\n') == b'# service=git-upload-pack'
@@ -625,21 +1589,36 @@ def fetch_pack(owner, repo):
         # Ignore the default ref, will be in the lates ones also
         data = next(it)
         if data is None:
+            release(conn)
+            if slot is not None:
+                global_governor.release(slot)
             return None
         ref1, cap = data.split(b'\0')
 
-        # Don't download all refs, just the first one
-        #refs = [i.split(b' ')[0] for i in it if i is not None]
-        refs = [ref1.split(b' ')[0]]
+        # Unless --refs is given, don't download all refs, just the first one
+        selected = None
+        if options.refs:
+            selected = select_refs([ref1] + [i for i in it if i is not None], options.refs)
+            if not selected:
+                print('No ref matches %s' % (options.refs,))
+                release(conn)
+                if slot is not None:
+                    global_governor.release(slot)
+                return None
+            refs = list(dict.fromkeys(sha for _, sha in selected))
+        else:
+            refs = [ref1.split(b' ')[0]]
 
-        lst = [b'want %s\n' % i for i in refs]
         caps = b'multi_ack_detailed no-done side-band-64k thin-pack ofs-delta agent='
         caps += options.user_agent.encode('ascii')
-        lst[0] = lst[0].rstrip(b'\n') + b' ' + caps
-        lst.append(None)
-        lst += [b'have %s\n' % i.encode('ascii') for i in files]
-        lst.append(b'done\n')
-        body = mk_pkt_line(lst)
+        haves = list(shared) + [sha.encode('ascii') for _, sha in files]
+
+        # If the server supports partial clones, it leaves out the trees we would drop anyway
+        filter_spec = None
+        max_depth = select_depth(options.select)
+        if max_depth is not None and b'filter' in cap.split():
+            caps += b' filter'
+            filter_spec = b'tree:%d' % (max_depth,)
 
         h1 = {
             'User-Agent': options.user_agent,
@@ -648,28 +1627,26 @@ def fetch_pack(owner, repo):
             'Accept': 'application/x-git-upload-pack-result'
         }
 
-
-        conn.request('POST', '/%s/%s.git/git-upload-pack' % (owner, repo), headers=h1, body=body)
-        r = conn.getresponse()
+        url = '/%s/%s.git/git-upload-pack' % (owner, repo)
+        r, nbytes, common = negotiate(conn, url, h1, refs, caps, haves, filter_spec)
         print('Done.')
 
-        while True:
-            num = int(r.read(4), 16)
-            assert num != 0
-            line = r.read(num - 4).rstrip(b'\n')
-            l = line.split(b' ')
-            assert len(l) in (1, 2, 3)
-            if l[0] == b'NAK': break
-            assert l[0] == b'ACK'
-            if len(l) == 2: break
-
         r_stream = Side_band_64k(r)
+        r_stream.conn = conn
+        r_stream.governor = global_governor
+        r_stream.slot = slot
+        r_stream.tip = refs[0].decode('ascii')
+        r_stream.refs = selected
+        r_stream.offered = sum(size for size, _ in files)
+        r_stream.saved = sum(size for size, sha in files if sha.encode('ascii') in common)
+        r_stream.shared = bool(shared)
+        r_stream.negotiation_bytes = nbytes
     except:
         conn.close()
+        if slot is not None:
+            global_governor.release(slot)
         raise
 
-    #dump('data.cache', r_stream)
-
     return r_stream
 
 def write_packfile_file(r, fname):
@@ -691,47 +1668,170 @@ def write_packfile_file(r, fname):
     f.write(h.digest())
     f.close()
 
-def write_packfile_stream(r, f):
-    _write_packfile_helper(r, f, 0)
+def write_packfile_stream(r, f, store=None, max_depth=None, tips=None):
+    # If tips (hex) are given, the objects reachable from them that are not in the pack are written
+    # as references into the store, see write_shared_refs
+    graph = {} if tips is not None else None
+    _write_packfile_helper(r, f, 0, store, max_depth, graph)
+    if tips is not None:
+        write_shared_refs(f, store, graph, tips, max_depth)
     f.write(bytes(21))
     
-def _write_packfile_helper(r, f, compression):
-    it = parse_pack(r)
+def _write_packfile_helper(r, f, compression, store=None, max_depth=None, graph=None):
     f.write(b'PACK\0\0\0\2\0\0\0\0')
     
     num = 0
-    for sha, o in parse_pack(r):
-        l = len(o.blob)
-        b = (o.typ << 4) | (l & 15)
-        l >>= 4
-        while l:
-            f.write(bytes([b | 128]))
-            b = l & 127
-            l >>= 7
-        f.write(bytes([b]))
-        f.write(zlib.compress(o.blob, compression))
+    prof = global_profiler
+    for sha, o in parse_pack(r, store=store, max_depth=max_depth):
+        if prof is not None: prof.push('write')
+        if graph is not None:
+            graph[sha] = graph_children(o)
+        if store is not None:
+            # Only write a reference, the object itself goes into the store (if it is not there yet)
+            sha_bin = bytes.fromhex(sha.decode('ascii'))
+            store.add(sha_bin, o.typ, o.blob)
+            f.write(mk_objhead(ObjType.OBJ_STORE_REF, 20))
+            f.write(sha_bin)
+        else:
+            f.write(mk_objhead(o.typ, len(o.blob)))
+            f.write(zlib.compress(o.blob, compression))
+        if prof is not None: prof.pop()
         num += 1
     return num
 
-def write_metadata_object(f, owner, repo):
-    time_start   = time.clock()
+def graph_children(o):
+    if o.typ == ObjType.OBJ_COMMIT:
+        return o.tree, o.parents
+    return [i[2] for i in o.entries if i[0] == b'40000']
+
+# Writes references to the history a fork shares with its parent, walking from tips through graph
+# (the objects of the pack) and the object store, up to max_depth
+def write_shared_refs(f, store, graph, tips, max_depth):
+    num = 0
+    def get(sha):
+        nonlocal num
+        if sha not in graph:
+            sha_bin = bytes.fromhex(sha.decode('ascii'))
+            if sha_bin not in store:
+                return None
+            typ, data = store.get(sha_bin)
+            f.write(mk_objhead(ObjType.OBJ_STORE_REF, 20))
+            f.write(sha_bin)
+            num += 1
+            graph[sha] = graph_children((Commit if typ == ObjType.OBJ_COMMIT else Tree).parse(data, False))
+        return graph[sha]
+
+    commits = list(tips)
+    seen = set(commits)
+    trees = [] # (sha, depth)
+    while commits:
+        c = get(commits.pop())
+        if c is None: continue
+        tree, parents = c
+        commits += [i for i in parents if i not in seen]
+        seen.update(parents)
+        if max_depth != 0:
+            trees.append((tree, 0))
+
+    tree_depth = {}
+    while trees:
+        sha, depth = trees.pop()
+        if tree_depth.get(sha, sys.maxsize) <= depth: continue
+        tree_depth[sha] = depth
+        subtrees = get(sha)
+        if subtrees is None or (max_depth is not None and depth + 1 >= max_depth): continue
+        trees += [(i, depth + 1) for i in subtrees]
+    print('Referenced %d objects shared with the parent' % (num,))
+
+# Repositories acquired with --refs have a REFS block after their header: 'REFS', the u32 length
+# of the data, then a line '<sha> <ref>\n' for each ref
+REFS_HEAD = struct.Struct('<I')
+
+def mk_refs(refs):
+    data = b''.join(b'%s %s\n' % (sha, name.encode('utf-8')) for name, sha in refs)
+    return b'REFS' + REFS_HEAD.pack(len(data)) + data
+
+def parse_refs(data):
+    result = []
+    for line in data.splitlines():
+        sha, name = line.split(b' ', 1)
+        result.append((name.decode('utf-8'), sha))
+    return result
+
+# Repositories acquired with a --select other than all have a SELE block after their header (and
+# the REFS block): 'SELE', the u32 length of the data, then the selection
+def select_depth(mode):
+    if mode == 'all':
+        return None
+    elif mode == 'commits':
+        return 0
+    name, _, depth = mode.partition(':')
+    if name != 'trees' or not depth.isdigit():
+        raise ValueError('Invalid object selection %s, must be one of all, commits, trees:<n>' % (mode,))
+    return int(depth)
+
+def mk_select(max_depth):
+    data = b'commits' if max_depth == 0 else b'trees:%d' % (max_depth,)
+    return b'SELE' + REFS_HEAD.pack(len(data)) + data
+
+def write_metadata_object(f, owner, repo, store=None, fetch=fetch_pack, spool=None):
+    time_start   = time.perf_counter()
 
     print('Acquiring %s/%s...' % (owner, repo))
     
-    r = fetch_pack(owner, repo)
-    if not r:
-        print('\nRepository not found, or no valid ref. (%.02fs)' % (time.clock() - time_start))
-    else:
-        # Write header
-        f.write(('REPO %s/%s\0' % (owner, repo)).encode('utf-8'))
-    
-        try:
-            write_packfile_stream(r, f)
-        finally:
-            r.close()
-        print('Done. (%.02fs)' % (time.clock() - time_start))
+    try:
+        max_depth = select_depth(options.select)
+    except ValueError as e:
+        die(str(e))
+
+    prof = global_profiler
+    if prof is not None:
+        prof.begin_repo()
+    r_orig = None
+    try:
+        shared = None
+        if store is not None and fetch is fetch_pack:
+            shared = fork_haves(store, owner, repo, max_depth)
+        with profile_stage('negotiate'):
+            r = r_orig = fetch(owner, repo, shared) if shared else fetch(owner, repo)
+        if r and spool is not None:
+            r = spool.tee(r, owner, repo, r.tip)
+        if not r:
+            print('\nRepository not found, or no valid ref. (%.02fs)' % (time.perf_counter()
+                - time_start))
+        else:
+            # Write header
+            f.write(('REPO %s/%s\0' % (owner, repo)).encode('utf-8'))
+            if getattr(r_orig, 'refs', None):
+                f.write(mk_refs(r_orig.refs))
+            if max_depth is not None:
+                f.write(mk_select(max_depth))
+        
+            if getattr(r_orig, 'refs', None):
+                tips = [sha for _, sha in r_orig.refs]
+            else:
+                tips = [r_orig.tip.encode('ascii')]
+            # A pack from the spool may be the thin one of a fork as well
+            complete = shared or (store is not None and fetch is not fetch_pack)
+            try:
+                write_packfile_stream(r, f, store, max_depth, tips if complete else None)
+            finally:
+                r.close()
+            if store is not None:
+                store.set_tips((owner, repo), tips, max_depth)
+            if 'total' in getattr(r_orig, 'progress', ()):
+                print('Server sent %d objects (%d deltas) in %.1f MiB' % (r_orig.progress['total'],
+                    r_orig.progress.get('delta', 0), r_orig.nbytes / 2**20))
+            if global_planner is not None and fetch is fetch_pack and not shared:
+                # (What the parent saved would be taken for the savings of the haves)
+                global_planner.record(owner, repo, r_orig.offered, r_orig.saved, r_orig.negotiation_bytes)
+            print('Done. (%.02fs)' % (time.perf_counter() - time_start))
+    finally:
+        if prof is not None:
+            prof.end_repo(owner, repo, nbytes=getattr(r_orig, 'nbytes', 0))
 
-def find_repos_and_offset(f):
+def find_repos_and_offset(f, starts=None):
+    # If starts is given, the offset of the header of each repository is appended to it
     buf = memoryview(global_64k_buffer)
     repos = []
     offset_last = 0
@@ -755,6 +1855,7 @@ def find_repos_and_offset(f):
     while True:
         start, end, rbyte, c = at_end(start, end, rbyte, 100)
         if c: break
+        offset_start = rbyte - (end - start)
                 
         # Find the next repo
         assert buf[start:start+5] == b'REPO '
@@ -763,6 +1864,23 @@ def find_repos_and_offset(f):
         i = buf[start:start+95].tobytes().find(b'\0')
         owner, repo = buf[start:start+i].tobytes().decode('utf-8').split('/')
         start += i + 1
+
+        start, end, rbyte, c = at_end(start, end, rbyte, 12)
+        if c: break
+        while buf[start:start+4] in (b'REFS', b'SELE'):
+            # Skip the block, it may be longer than the buffer
+            n = REFS_HEAD.unpack_from(buf, start + 4)[0]
+            start += REFS_HEAD.size + 4
+            while n:
+                start, end, rbyte, c = at_end(start, end, rbyte, 1)
+                if c: break
+                k = min(n, end - start)
+                start += k
+                n -= k
+            if c: break
+            start, end, rbyte, c = at_end(start, end, rbyte, 12)
+            if c: break
+        if c: break # truncated within the blocks, keep the previous repository
         
         assert buf[start:start+8] == b'PACK\0\0\0\2' 
         start += 12
@@ -775,6 +1893,11 @@ def find_repos_and_offset(f):
             # Read the object
             typ, size, start = objhead(buf, start)
             if typ == ObjType.OBJ_NONE: break
+            if typ == ObjType.OBJ_STORE_REF:
+                start, end, rbyte, c = at_end(start, end, rbyte, 20)
+                if c: flag = False; break
+                start += 20
+                continue
             assert typ in (ObjType.OBJ_COMMIT, ObjType.OBJ_TREE)
             
             o = zlib.decompressobj()
@@ -793,18 +1916,78 @@ def find_repos_and_offset(f):
         if not flag: break
                     
         repos.append((owner, repo))
+        if starts is not None:
+            starts.append(offset_start)
         offset_last = rbyte - (end - start)
         print('Found repository %s/%s' % (owner, repo))
         
     return repos, offset_last
 
+# Yields ((owner, repo), it) like parse_pack, each it has to be consumed before the next. Without
+# magic, f is at a header. starts collects header offsets, refs and modes the REFS and SELE blocks.
+def read_alarmfile(f, store=None, do_parse=True, do_blobs=False, classes=None, magic=True,
+                   starts=None, refs=None, modes=None):
+    buf = memoryview(global_64k_buffer)
+    if magic and f.read(4) != ALARMFILE_MAGIC:
+        raise Pack_error('Not an alarmfile')
+
+    def refill(start, end):
+        # Move the remaining data to the front, and fill up the rest of the buffer
+        buf[:end-start] = buf[start:end]
+        end -= start
+        return 0, end + f.readinto(buf[end:])
+
+    stream_state = [0, 0, False]
+    while True:
+        start, end = refill(*stream_state[:2])
+        if starts is not None:
+            starts.append(f.tell() - end)
+        if start == end: break
+
+        if buf[start:start+5] != b'REPO ':
+            raise Pack_error('Expected the header of a repository')
+        start += 5
+        i = buf[start:start+MAX_HEADER_SIZE].tobytes().find(b'\0')
+        if i == -1:
+            raise Pack_error('Header of a repository is too long')
+        owner, repo = buf[start:start+i].tobytes().decode('utf-8').split('/')
+        start += i + 1
+
+        while True:
+            if end - start < REFS_HEAD.size + 4:
+                start, end = refill(start, end)
+            if buf[start:start+4] not in (b'REFS', b'SELE'): break
+            block = buf[start:start+4].tobytes()
+            n = REFS_HEAD.unpack_from(buf, start + 4)[0]
+            start += REFS_HEAD.size + 4
+            data = buf[start:min(end, start + n)].tobytes()
+            start += len(data)
+            if len(data) < n:
+                data += f.read(n - len(data))
+                if len(data) < n:
+                    raise Pack_error('Unexpected end of the header of %s/%s' % (owner, repo))
+                # Everything in the buffer has been used up
+                start = 0
+                end = f.readinto(buf)
+            if block == b'REFS' and refs is not None:
+                refs[owner, repo] = parse_refs(data)
+            elif block == b'SELE' and modes is not None:
+                modes[owner, repo] = data.decode('ascii')
+
+        # parse_pack only reads into the space after end
+        start, end = refill(start, end)
+        stream_state[0] = start
+        stream_state[1] = end
+        yield (owner, repo), parse_pack(f, do_parse=do_parse, do_summary=False,
+            stream_state=stream_state, do_blobs=do_blobs, store=store, classes=classes)
+
 def copy_bytes(fr, to, rbyte):
     buf = memoryview(global_64k_buffer)
-    time_last = time.clock()
+    time_last = time.perf_counter()
     i = 0
     while i < rbyte:
-        if time.clock() > time_last + 1:
-            time_last = time.clock()
+        if time.perf_counter() > time_last + 1:
+            time_last = time.perf_counter()
             print('Copying... (%2.02f%%)' % (i / rbyte * 100))
         
         num = fr.readinto(buf)
@@ -814,10 +1997,592 @@ def copy_bytes(fr, to, rbyte):
         i += towrite
     assert i == rbyte
 
+# Size of the blocks the output is cut into before compressing. Each block becomes an independent
+# member (gzip) or stream (lzma), so larger blocks compress slightly better but need more memory per
+# thread.
+COMPRESS_BLOCK_SIZE = 4 * 2**20
+
+XZ_MAGIC = b'\xfd7zXZ\0'
+
+def parse_codec(s):
+    name, _, level = s.partition(':')
+    if name == 'gzip':
+        default, valid = 7, range(0, 10)
+    elif name == 'lzma':
+        default, valid = 6, range(0, 10)
+    else:
+        die('Unknown codec %s, must be one of gzip, lzma' % (name,))
+
+    try:
+        level = int(level) if level else default
+    except ValueError:
+        die('Invalid compression level in %s' % (s,))
+    if level not in valid:
+        die('Compression level for %s must be between %d and %d' % (name, valid[0], valid[-1]))
+    return name, level
+
+def compress_block(codec, data):
+    # Both zlib and lzma release the GIL while compressing, so this can run on a thread pool
+    name, level = codec
+    if name == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    else:
+        return lzma.compress(data, preset=level)
+
+# Compresses the output in blocks on a thread pool, pigz-style
+class Parallel_compressor(io.RawIOBase):
+    def __init__(self, f, codec, threads=0, block_size=COMPRESS_BLOCK_SIZE, closefd=True):
+        import concurrent.futures
+        
+        self.f = f
+        self.closefd = closefd
+        self.codec = codec
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = memoryview(b).nbytes
+        self.buf += b
+        self.pos += n
+        while len(self.buf) >= self.block_size:
+            self._submit()
+        return n
+
+    def tell(self):
+        # Position in the uncompressed stream, same as for gzip.open
+        return self.pos
+
+    def _submit(self):
+        block = self.buf[:self.block_size]
+        del self.buf[:self.block_size]
+        self.pending.append(self.pool.submit(compress_block, self.codec, block))
+
+        # Keep the number of blocks in flight bounded, else memory usage explodes on slow codecs
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed: return
+        try:
+            if self.buf or not self.pos:
+                self._submit()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            if self.closefd:
+                self.f.close()
+            super().close()
+
+def create_alarmfile(fname):
+    f = open(fname, 'xb')
+    return io.BufferedWriter(Parallel_compressor(f, parse_codec(options.compress), options.threads))
+
+def open_alarmfile(fname):
+    with open(fname, 'rb') as f:
+        magic = f.read(len(XZ_MAGIC))
+    if magic == XZ_MAGIC:
+        return lzma.open(fname, 'rb')
+    else:
+        return gzip.open(fname, 'rb')
+
+STORE_INDEX_NAME = 'store.idx'
+STORE_BLOOM_NAME = 'store.bloom'
+STORE_SORTED_NAME = 'store.sidx'
+STORE_LOCK_NAME = 'store.lock'
+STORE_TIPS_NAME = 'store.tips'
+STORE_PACK_NAME = 'store_%04d.pack'
+STORE_BLOOM_MAGIC = b'\xb1\x00\x0f\x11'
+STORE_SORTED_MAGIC = b'\x51\xd0\x0f\x11'
+STORE_SORTED_TAIL = 2**16 # records that may be kept outside of the sorted index, at least
+STORE_PACK_MAX_SIZE = 2**30
+STORE_BLOOM_BITS = 2**27 # 16 MiB, about 0.4% false positives at 10M objects
+
+def process_gone(hostname, pid):
+    # Whether the process pid on host hostname is known to have exited. Only processes on this
+    # machine can be checked.
+    import socket
+    if hostname != socket.gethostname() or not pid.isdigit() or os.name != 'posix':
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+class Bloom_filter:
+    # The hashes are sha1 values, so we can just use slices of them as hash functions
+    _slices = struct.Struct('<5I')
+    
+    def __init__(self, nbits, bits=None):
+        assert nbits & (nbits - 1) == 0
+        self.nbits = nbits
+        self.bits = bytearray(nbits // 8) if bits is None else bits
+
+    def add(self, sha):
+        mask = self.nbits - 1
+        for i in self._slices.unpack_from(sha):
+            i &= mask
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, sha):
+        mask = self.nbits - 1
+        for i in self._slices.unpack_from(sha):
+            i &= mask
+            if not self.bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+# Content-addressed store of commits and trees, shared across alarmfiles (see --store and File
+# format in the README)
+class Object_store:
+    # sha, pack number, offset, length of the stored object (including header)
+    RECORD = struct.Struct('!20sHQI')
+    
+    def __init__(self, path, readonly=False):
+        # A readonly store can be used by multiple processes at once
+        self.path = path
+        self.readonly = readonly
+        if not os.path.isdir(path):
+            if readonly:
+                raise FileNotFoundError('Object store %s does not exist' % (path,))
+            print('%s does not exist, will be created' % (path,))
+            os.makedirs(path)
+
+        self.fname_idx = os.path.join(path, STORE_INDEX_NAME)
+        self.fname_bloom = os.path.join(path, STORE_BLOOM_NAME)
+        self.fname_sorted = os.path.join(path, STORE_SORTED_NAME)
+        self.fname_lock = os.path.join(path, STORE_LOCK_NAME)
+        if not readonly:
+            self._lock()
+        self.fname_tips = os.path.join(path, STORE_TIPS_NAME)
+        self._tips = None # maps 'owner/repo' -> (tips, max_depth), loaded on first use
+        self.tips_changed = False
+
+        # Get rid of partially written records
+        if not os.path.exists(self.fname_idx) and not readonly:
+            open(self.fname_idx, 'wb').close()
+        self.count = 0
+        if os.path.exists(self.fname_idx):
+            self.count = os.path.getsize(self.fname_idx) // self.RECORD.size
+        if not readonly:
+            self.count = self._valid_count()
+            with open(self.fname_idx, 'r+b') as f:
+                f.truncate(self.count * self.RECORD.size)
+            self.f_idx = open(self.fname_idx, 'ab')
+
+        self.bloom = self._load_bloom()
+        self.sorted = None
+        self.sorted_count = 0
+        self.tail = None # maps sha -> (pack, offset, length) for the records after sorted_count
+        self.added = 0
+
+        self.packno = 0
+        while os.path.exists(self._pack_name(self.packno + 1)):
+            self.packno += 1
+        if not readonly:
+            self.f_pack = open(self._pack_name(self.packno), 'ab')
+        self.readers = {}
+
+    def _lock(self):
+        # Writers append at offsets they keep track of, and replace the other files on close, so
+        # there must be only one
+        import socket
+        tmp = '%s.%d.tmp' % (self.fname_lock, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('%s %d' % (socket.gethostname(), os.getpid()))
+        try:
+            while True:
+                try:
+                    os.link(tmp, self.fname_lock)
+                    return
+                except FileExistsError:
+                    pass
+                try:
+                    with open(self.fname_lock, 'r') as f:
+                        holder = f.read()
+                except FileNotFoundError:
+                    continue
+                hostname, _, pid = holder.rpartition(' ')
+                if not process_gone(hostname, pid):
+                    die('The object store %s is in use by process %s on %s. Only one process may add '
+                        'objects at a time, remove %s if it is gone.' % (self.path, pid, hostname,
+                        self.fname_lock))
+                print('Removing stale lock of object store %s, held by %s' % (self.path, holder))
+                # As for leases, another process may have replaced it in the meantime
+                broken = '%s.%d.broken' % (self.fname_lock, os.getpid())
+                try:
+                    os.rename(self.fname_lock, broken)
+                except FileNotFoundError:
+                    continue
+                with open(broken, 'r') as f:
+                    if f.read() != holder:
+                        try:
+                            os.link(broken, self.fname_lock)
+                        except FileExistsError:
+                            pass
+                os.remove(broken)
+        finally:
+            os.remove(tmp)
+
+    def _valid_count(self):
+        # The index is flushed on its own, so after a crash its last records may point past the end
+        # of the pack data. Returns the number of records before those.
+        size = self.RECORD.size
+        sizes = {}
+        count = self.count
+        with open(self.fname_idx, 'rb') as f:
+            while count:
+                f.seek((count - 1) * size)
+                _, packno, offset, length = self.RECORD.unpack(f.read(size))
+                if packno not in sizes:
+                    fname = self._pack_name(packno)
+                    sizes[packno] = os.path.getsize(fname) if os.path.exists(fname) else 0
+                if offset + length <= sizes[packno]:
+                    break
+                count -= 1
+        if count < self.count:
+            print('Dropping %d records of object store %s that point past the end of the data' % (
+                self.count - count, self.path))
+        return count
+
+    def _pack_name(self, packno):
+        return os.path.join(self.path, STORE_PACK_NAME % (packno,))
+    
+    def _raw_records(self, start=0):
+        size = self.RECORD.size
+        if start >= self.count:
+            return b''
+        with open(self.fname_idx, 'rb') as f:
+            f.seek(start * size)
+            return f.read((self.count - start) * size)
+
+    def _records(self, start=0):
+        return self.RECORD.iter_unpack(self._raw_records(start))
+
+    def _load_bloom(self):
+        if os.path.isfile(self.fname_bloom):
+            with open(self.fname_bloom, 'rb') as f:
+                data = f.read()
+            if data[:4] == STORE_BLOOM_MAGIC:
+                nbits, count = struct.unpack('!QQ', data[4:20])
+                if count <= self.count and len(data) == 20 + nbits // 8:
+                    # The index is only ever appended to, so add what is missing (e.g. another
+                    # process is adding objects, or we crashed before writing it)
+                    bloom = Bloom_filter(nbits, bytearray(data[20:]))
+                    for sha, _, _, _ in self._records(count):
+                        bloom.add(sha)
+                    return bloom
+            
+        # Missing or does not match the index, rebuild it
+        if self.count:
+            print('Rebuilding Bloom filter of object store %s...' % (self.path,))
+        bloom = Bloom_filter(STORE_BLOOM_BITS)
+        for sha, _, _, _ in self._records():
+            bloom.add(sha)
+        return bloom
+
+    def _open_sorted(self):
+        # Returns the mapped sorted index and the number of records in it, or (None, 0)
+        import mmap
+        try:
+            f = open(self.fname_sorted, 'rb')
+        except FileNotFoundError:
+            return None, 0
+        with f:
+            head = f.read(12)
+            if len(head) < 12 or head[:4] != STORE_SORTED_MAGIC:
+                return None, 0
+            n, = struct.unpack('!Q', head[4:])
+            # Another process may have merged more records since we opened the index, which is
+            # fine for reading, but a writer must not have fewer records than the sorted index
+            if n == 0 or os.path.getsize(self.fname_sorted) != 12 + n * self.RECORD.size \
+                    or (n > self.count and not self.readonly):
+                return None, 0
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), n
+
+    def _load(self):
+        if self.tail is not None: return
+        if not self.readonly:
+            self.f_idx.flush()
+        self.sorted, self.sorted_count = self._open_sorted()
+        self.tail = {sha: (packno, off, l)
+            for sha, packno, off, l in self._records(min(self.sorted_count, self.count))}
+
+    def _find(self, sha):
+        # Returns (pack, offset, length) of the object, or None
+        if sha not in self.bloom:
+            return None
+        self._load()
+        loc = self.tail.get(sha)
+        if loc is not None:
+            return loc
+        
+        m = self.sorted
+        size = self.RECORD.size
+        lo, hi = 0, self.sorted_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = 12 + mid * size
+            s = m[k:k+20]
+            if s < sha:
+                lo = mid + 1
+            elif s > sha:
+                hi = mid
+            else:
+                return self.RECORD.unpack_from(m, k)[1:]
+        return None
+
+    def _merge_sorted(self):
+        # Merge the records that are not in the sorted index into it
+        import heapq
+        m, n = (self.sorted, self.sorted_count) if self.tail is not None else self._open_sorted()
+        if self.count - n < max(STORE_SORTED_TAIL, n // 8):
+            return
+        
+        print('Updating sorted index of object store %s...' % (self.path,))
+        size = self.RECORD.size
+        data = self._raw_records(n)
+        # The hash comes first, so sorting the records sorts by hash
+        tail = sorted(data[k:k+size] for k in range(0, len(data), size))
+        old = (m[k:k+size] for k in range(12, 12 + n * size, size))
+        
+        fname_tmp = self.fname_sorted + '.tmp'
+        with open(fname_tmp, 'wb') as f:
+            f.write(STORE_SORTED_MAGIC)
+            f.write(struct.pack('!Q', self.count))
+            buf = bytearray()
+            for r in heapq.merge(old, tail):
+                buf += r
+                if len(buf) >= 2**20:
+                    f.write(buf)
+                    buf.clear()
+            f.write(buf)
+        if m is not None:
+            m.close()
+        self.sorted = None
+        os.replace(fname_tmp, self.fname_sorted)
+
+    def __contains__(self, sha):
+        return self._find(sha) is not None
+
+    def __len__(self):
+        return self.count
+
+    # Returns whether the object was new
+    def add(self, sha, typ, data):
+        if sha in self:
+            return False
+
+        if self.f_pack.tell() > STORE_PACK_MAX_SIZE:
+            self.f_pack.close()
+            self.packno += 1
+            self.f_pack = open(self._pack_name(self.packno), 'ab')
+
+        b = mk_objhead(typ, len(data)) + zlib.compress(data)
+        loc = self.packno, self.f_pack.tell(), len(b)
+        self.f_pack.write(b)
+        self.f_idx.write(self.RECORD.pack(sha, *loc))
+        self.bloom.add(sha)
+        if self.tail is not None:
+            self.tail[sha] = loc
+        self.count += 1
+        self.added += 1
+        return True
+
+    # Returns (typ, data), sha is binary
+    def get(self, sha):
+        loc = self._find(sha)
+        if loc is None:
+            raise KeyError('Object %s is not in the object store %s' % (sha.hex(), self.path))
+        packno, off, l = loc
+        if packno == self.packno and not self.readonly:
+            self.f_pack.flush()
+        if packno not in self.readers:
+            self.readers[packno] = open(self._pack_name(packno), 'rb')
+        f = self.readers[packno]
+        f.seek(off)
+        b = f.read(l)
+        typ, size, i = objhead(b)
+        data = zlib.decompress(b[i:])
+        if len(data) != size:
+            raise Pack_error('Object %s in the object store is corrupt' % (sha.hex(),))
+        return typ, data
+
+    def _load_tips(self):
+        if self._tips is not None: return
+        self._tips = {}
+        if os.path.isfile(self.fname_tips):
+            with open(self.fname_tips, 'r') as f:
+                self._tips = json.loads(f.read())
+
+    def has_tips(self):
+        self._load_tips()
+        return bool(self._tips)
+
+    # Tips (hex) and selection of the last acquisition of a repository with this store, or empty
+    def tips(self, repo):
+        self._load_tips()
+        tips, max_depth = self._tips.get('/'.join(repo), ([], None))
+        return tips, max_depth
+
+    def set_tips(self, repo, tips, max_depth):
+        self._load_tips()
+        self._tips['/'.join(repo)] = [i.decode('ascii') for i in tips], max_depth
+        self.tips_changed = True
+
+    def flush(self):
+        # Data first, so that the index never points to missing data
+        self.f_pack.flush()
+        self.f_idx.flush()
+
+    def close(self):
+        for f in self.readers.values():
+            f.close()
+        if self.readonly:
+            if self.sorted is not None:
+                self.sorted.close()
+            return
+        
+        self.flush()
+        self.f_pack.close()
+        self.f_idx.close()
+        self._merge_sorted()
+        if self.sorted is not None:
+            self.sorted.close()
+
+        fname_tmp = self.fname_bloom + '.tmp'
+        with open(fname_tmp, 'wb') as f:
+            f.write(STORE_BLOOM_MAGIC)
+            f.write(struct.pack('!QQ', self.bloom.nbits, self.count))
+            f.write(self.bloom.bits)
+        os.replace(fname_tmp, self.fname_bloom)
+
+        if self.tips_changed:
+            with open(self.fname_tips + '.tmp', 'w') as f:
+                f.write(json.dumps(self._tips))
+            os.replace(self.fname_tips + '.tmp', self.fname_tips)
+        os.remove(self.fname_lock)
+
+# Commands that only read pass readonly, so that they do not get in the way of a writer
+def open_object_store(readonly=False):
+    if not options.store:
+        return None
+    path = os.path.join(options.data, options.store)
+    if readonly and not os.path.isdir(path):
+        die('The object store (%s) does not exist!' % (path,))
+    return Object_store(path, readonly)
+
+SPOOL_PACK_NAME = '%s@%s@%s.pack' # '@' cannot occur in owner or repository names
+
+# On-disk cache of raw packs, keyed by repository and tip. The least recently used packs are
+# removed once it grows larger than max_size.
+class Pack_spool:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            print('%s does not exist, will be created' % (path,))
+            os.makedirs(path)
+
+    def _packs(self):
+        result = []
+        for i in os.listdir(self.path):
+            l = i.split('@')
+            if not i.endswith('.pack') or len(l) != 3: continue
+            fname = os.path.join(self.path, i)
+            st = os.stat(fname)
+            result.append((st.st_mtime, st.st_size, fname, (l[0], l[1])))
+        return result
+
+    def repos(self):
+        return sorted({repo for _, _, _, repo in self._packs()})
+
+    def tee(self, r, owner, repo, tip):
+        fname = os.path.join(self.path, SPOOL_PACK_NAME % (owner, repo, tip))
+        return Spool_tee(self, r, fname)
+
+    # The most recent pack of the repository, or None
+    def open(self, owner, repo):
+        packs = [i for i in self._packs() if i[3] == (owner, repo)]
+        if not packs:
+            print('No pack of %s/%s in the spool' % (owner, repo))
+            return None
+        _, _, fname, _ = max(packs)
+        os.utime(fname) # for the LRU
+        f = open(fname, 'rb')
+        f.tip = os.path.basename(fname).split('@')[2][:-len('.pack')]
+        return f
+
+    def evict(self):
+        packs = self._packs()
+        packs.sort()
+        total = sum(size for _, size, _, _ in packs)
+        for _, size, fname, _ in packs:
+            if total <= self.max_size: break
+            print('Removing %s from the spool' % (os.path.basename(fname),))
+            os.remove(fname)
+            total -= size
+
+# Copies a pack stream into the spool, it is kept if complete even if parsing failed
+class Spool_tee:
+    def __init__(self, spool, r, fname):
+        self.spool = spool
+        self.r = r
+        self.tip = r.tip
+        self.fname = fname
+        self.f = open(fname + '.tmp', 'wb')
+
+    def readinto(self, buf):
+        num = self.r.readinto(buf)
+        self.f.write(memoryview(buf)[:num])
+        return num
+
+    def read(self, num):
+        buf = bytearray(num)
+        num = self.readinto(buf)
+        return buf[:num]
+
+    def close(self):
+        try:
+            # Make sure we have everything, parse_pack may have stopped early
+            buf = memoryview(global_64k_buffer)
+            while self.readinto(buf): pass
+        except:
+            self.f.close()
+            os.remove(self.fname + '.tmp')
+            raise
+        else:
+            self.f.close()
+            os.replace(self.fname + '.tmp', self.fname)
+            self.spool.evict()
+        finally:
+            self.r.close()
+
+def open_spool():
+    if not options.spool:
+        return None
+    return Pack_spool(os.path.join(options.data, options.spool), options.spool_max * 2**20)
+
 # Quick hack for repositories that break alarm. Currently only this one.
 repos_to_skip = [('Homebrew', 'legacy-homebrew')]
 
-def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
+# Returns the repositories that were acquired into fname
+def acquire_metadata(fname, repos_arg, idx, force_if_empty=False, fetch=fetch_pack):
+    global global_planner, global_governor, global_profiler
+    ledger = idx.ledger
+    if ledger is not None:
+        fname = ledger.shard_name(fname)
+        print('Writing into the shard %s of host %s' % (os.path.basename(fname), ledger.host))
     dname = os.path.basename(fname)
 
     repos = []
@@ -828,11 +2593,31 @@ def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
         if i in repos_to_skip:
             print("Skipping repository %s" % ('/'.join(i),))
             continue
+        other = ledger.done(i) if ledger is not None else None
+        if other is not None:
+            print("Skipping repository %s, already acquired into file %s" % ('/'.join(i), other))
+            continue
         repos.append(i)
 
     if not repos and not force_if_empty:
         print('No repositories left to acquire.')
-        return
+        return []
+
+    own_profiler = options.profile and global_profiler is None
+    if own_profiler:
+        global_profiler = Profiler(options.profile.split(','))
+
+    if fetch is fetch_pack:
+        prefetch_trees(repos)
+        spool = open_spool()
+        if global_governor is None:
+            global_governor = open_governor()
+    else:
+        spool = None
+    # The daemon keeps its planner
+    own_planner = fetch is fetch_pack and global_planner is None
+    if own_planner:
+        global_planner = Have_planner(os.path.join(options.data, PLANNER_STATE_NAME))
     
     f = None
     if os.path.exists(fname):
@@ -844,7 +2629,7 @@ def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
             if not os.path.exists(fname2): break
             i += 1
         os.rename(fname, fname2)
-        f2 = gzip.open(fname2, 'rb')
+        f2 = open_alarmfile(fname2)
 
         if dname in idx.files:
             print('File %s is in the index, skipping right ahead...' % (dname,))
@@ -853,7 +2638,7 @@ def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
             
             # Copying the whole file is, quite frankly, ludicrously inefficient. Sadly I do not see
             # an easy way to avoid it.
-            f1 = io.BufferedWriter(gzip.open(fname, 'xb', compresslevel=5))
+            f1 = create_alarmfile(fname)
             copy_bytes(f2, f1, offset)
             f2.close()
             
@@ -878,13 +2663,15 @@ def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
                 print('Found %d repositories.' % len(repos_have))
 
                 # see above
-                f1 = io.BufferedWriter(gzip.open(fname, 'xb', compresslevel=5))
-                f2 = gzip.open(fname2, 'rb')            
+                f1 = create_alarmfile(fname)
+                f2 = open_alarmfile(fname2)            
                 copy_bytes(f2, f1, offset)
                 f2.close()
                 
                 idx.setfile(dname, os.path.getsize(fname), offset, repos_have)
                 save_index(idx)
+                if ledger is not None:
+                    ledger.commit(repos_have, dname)
                 
                 for i in repos_have:
                     if i in repos:
@@ -895,24 +2682,51 @@ def acquire_metadata(fname, repos_arg, idx, force_if_empty=False):
                 f = f1
 
     if f is None:
-        f = io.BufferedWriter(gzip.open(fname, 'xb', compresslevel=7))
+        f = create_alarmfile(fname)
         f.write(ALARMFILE_MAGIC)
         offset = 0
         repos_have = []
 
+    store = open_object_store()
+    acquired = []
+    if ledger is not None:
+        ledger.start()
     try:
         for owner, repo in repos:
-            write_metadata_object(f, owner, repo)
+            if ledger is not None:
+                holder = ledger.claim((owner, repo))
+                if holder is not None:
+                    print('Skipping repository %s/%s, claimed by %s' % (owner, repo, holder))
+                    continue
+            write_metadata_object(f, owner, repo, store, fetch, spool)
+            if store is not None:
+                store.flush()
             offset = f.tell()
             repos_have.append((owner, repo))
+            acquired.append((owner, repo))
 
             if global_stop_flag: break
     finally:
         f.close()
+        if store is not None:
+            print('Object store: %d objects, %d new' % (len(store), store.added))
+            store.close()
+        if own_planner:
+            global_planner.report()
+            global_planner.save()
+            global_planner = None
+        if own_profiler:
+            global_profiler.report(os.path.join(options.data, PROFILE_NAME))
+            global_profiler = None
         if offset:
             dname = os.path.basename(fname)
             idx.setfile(dname, os.path.getsize(fname), offset, repos_have)
         save_index(idx)
+        if ledger is not None:
+            # The repositories are in the index now
+            ledger.commit(acquired, dname)
+            ledger.stop()
+    return acquired
 
 def fileify(s):
     return ''.join(i for i in s.lower() if i not in ' /\\?*:|"\'<>' and i.isprintable())    
@@ -924,15 +2738,39 @@ class Index:
     def __init__(self):
         self.files = {} # maps file -> (size, offset)
         self.repos = {} # maps repo -> file
+        self.changed = set() # files that were set or removed by this process, see merge
+        self.ledger = None
 
     def setfile(self, dname, size, offset, repos):
         self.files[dname] = size, offset
+        self.changed.add(dname)
         for i in repos:
             if i in self.repos and self.repos[i] != dname:
                 print('Warning: Repository %s is contained in both %s and %s' % (i, dname, self.repos[i]))
             else:
                 self.repos[i] = dname
 
+    def removefiles(self, dnames):
+        self.files = {k: v for k, v in self.files.items() if k not in dnames}
+        self.repos = {k: v for k, v in self.repos.items() if v not in dnames}
+        self.changed.update(dnames)
+
+    # Merges the index another process has written, the files we changed are taken from self
+    def merge(self, data):
+        files = {k: v for k, v in data['files'].items() if k not in self.changed}
+        repos = {tuple(k.split('/')): v for k, v in data['repos'].items() if v in files}
+        for dname in self.changed:
+            if dname in self.files:
+                files[dname] = self.files[dname]
+        for i, dname in self.repos.items():
+            if dname not in self.changed or dname not in files: continue
+            if i in repos and repos[i] != dname:
+                print('Warning: Repository %s is contained in both %s and %s' % (i, dname, repos[i]))
+            else:
+                repos[i] = dname
+        self.files = files
+        self.repos = repos
+
 def init_index(also_rebuild=False):
     data_dir = options.data
     if not os.path.isdir(data_dir):
@@ -940,6 +2778,7 @@ def init_index(also_rebuild=False):
 
     idx = Index()
     idx.fname = os.path.join(options.data, options.index)
+    idx.ledger = open_ledger()
              
     if os.path.isdir(idx.fname):
         die('%s is a directory, was supposed to be an indexfile' % (idx_fname,))
@@ -973,9 +2812,11 @@ def init_index(also_rebuild=False):
             fname = os.path.join(data_dir, dname)
             if dname in up_to_date: continue
             print('Currently indexing %s...' % (fname,))
-            with gzip.open(fname, 'rb') as f:
-                assert f.read(4) == ALARMFILE_MAGIC
+            with open_alarmfile(fname) as f:
+                if f.read(4) != ALARMFILE_MAGIC:
+                    raise Pack_error('%s is not an alarmfile' % (fname,))
                 repos, offset = find_repos_and_offset(f)
+            offset += 4 # include the magic, as acquire_metadata does
 
             idx.setfile(dname, os.path.getsize(fname), offset, repos)
 
@@ -984,9 +2825,210 @@ def init_index(also_rebuild=False):
     return idx
 
 def save_index(idx):
-    with open(idx.fname, 'w') as f:
-        repos = {'/'.join(i): j for i,j in idx.repos.items()}
-        f.write(json.dumps({'files': idx.files, 'repos': repos}, indent = 4))
+    if idx.ledger is not None:
+        # Other hosts write the index as well, include their changes
+        idx.ledger.lock()
+    try:
+        if idx.ledger is not None and os.path.isfile(idx.fname):
+            with open(idx.fname, 'r') as f:
+                idx.merge(json.loads(f.read()))
+        
+        # Write to a temporary file first, so that readers (and the daemon) never see half an index
+        with open(idx.fname + '.tmp', 'w') as f:
+            repos = {'/'.join(i): j for i,j in idx.repos.items()}
+            f.write(json.dumps({'files': idx.files, 'repos': repos}, indent = 4))
+        os.replace(idx.fname + '.tmp', idx.fname)
+    finally:
+        if idx.ledger is not None:
+            idx.ledger.unlock()
+
+LEDGER_LEASE_NAME = '%s@%s.lease' # '@' cannot occur in owner or repository names
+LEDGER_DONE_NAME = '%s@%s.done'
+LEDGER_ALIVE_NAME = '%s.alive'
+LEDGER_LOCK_NAME = 'index.lock'
+LEDGER_POLL = 0.1 # seconds between attempts to lock the index
+
+# Lets several hosts acquire into one data directory on a shared filesystem (see Ledger format in
+# the README). Only files are used, as flock does not work reliably across hosts.
+class Ledger:
+    def __init__(self, path, host, lease_time):
+        import socket
+        self.path = path
+        self.host = host
+        self.hostname = socket.gethostname()
+        self.lease_time = lease_time
+        self.held = set()
+        self.thread = None
+        if not os.path.isdir(path):
+            print('%s does not exist, will be created' % (path,))
+            os.makedirs(path)
+
+    def _read(self, fname):
+        try:
+            with open(fname, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            return ''
+
+    def _write(self, fname, data):
+        tmp = '%s.%s.tmp' % (fname, self.host)
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, fname)
+
+    def _alive(self, host, lease):
+        if not host:
+            # Leases are linked into place with their content, so this one is garbled or from
+            # something else. Only its age tells whether it is stale.
+            try:
+                return time.time() - os.path.getmtime(lease) < self.lease_time
+            except FileNotFoundError:
+                return False
+        if host == self.host:
+            # Our own leases from an earlier run are stale, the current ones are in self.held
+            return False
+        alive = os.path.join(self.path, LEDGER_ALIVE_NAME % (host,))
+        try:
+            mtime = os.path.getmtime(alive)
+        except FileNotFoundError:
+            return False
+        if process_gone(*(self._read(alive) or '').rpartition(' ')[::2]):
+            return False
+        return time.time() - mtime < self.lease_time
+
+    def shard_name(self, fname):
+        if fname.endswith('.alarm.gz'):
+            fname = fname[:-len('.alarm.gz')]
+        return '%s.%s.alarm.gz' % (fname, self.host)
+
+    # The file the repository has been committed to, or None
+    def done(self, repo):
+        return self._read(os.path.join(self.path, LEDGER_DONE_NAME % repo))
+
+    # Returns the host holding the lease, or None if we got it
+    def claim(self, repo):
+        fname = os.path.join(self.path, LEDGER_LEASE_NAME % repo)
+        tmp = '%s.%s.tmp' % (fname, self.host)
+        with open(tmp, 'w') as f:
+            f.write(self.host)
+        try:
+            return self._claim(repo, fname, tmp)
+        finally:
+            os.remove(tmp)
+
+    def _claim(self, repo, fname, tmp):
+        while True:
+            try:
+                # Unlike creating it with O_EXCL and writing it afterwards, this makes the lease
+                # appear together with its holder
+                os.link(tmp, fname)
+            except FileExistsError:
+                holder = self._read(fname)
+                if holder is None: continue # released in the meantime
+                if self._alive(holder, fname):
+                    return holder or 'another host'
+                
+                # Break the lease. Renaming is atomic, but someone else may have broken it first and
+                # claimed it again, in which case we put their lease back.
+                broken = '%s.%s.broken' % (fname, self.host)
+                try:
+                    os.rename(fname, broken)
+                except FileNotFoundError:
+                    continue
+                if self._read(broken) != holder:
+                    try:
+                        os.link(broken, fname)
+                    except FileExistsError:
+                        pass
+                os.remove(broken)
+                print('Lease of %s by host %s has expired, taking over' % ('/'.join(repo), holder or '?'))
+                continue
+            
+            if self.done(repo) is not None:
+                # Committed between the check in acquire_metadata and now
+                os.remove(fname)
+                return 'another host'
+            self.held.add(repo)
+            return None
+
+    # The repositories have to be in the index already, releases their leases
+    def commit(self, repos, dname):
+        for repo in repos:
+            self._write(os.path.join(self.path, LEDGER_DONE_NAME % repo), dname)
+            fname = os.path.join(self.path, LEDGER_LEASE_NAME % repo)
+            holder = self._read(fname)
+            if repo in self.held and holder not in (None, self.host):
+                print('Warning: Lease of %s was taken over by host %s, it may have been acquired twice'
+                    % ('/'.join(repo), holder))
+            elif holder == self.host:
+                os.remove(fname)
+            self.held.discard(repo)
+
+    def start(self):
+        import threading
+        alive = os.path.join(self.path, LEDGER_ALIVE_NAME % (self.host,))
+        self._write(alive, '%s %d' % (self.hostname, os.getpid()))
+        self.stop_event = threading.Event()
+        def heartbeat():
+            while not self.stop_event.wait(self.lease_time / 4):
+                os.utime(alive)
+        self.thread = threading.Thread(target=heartbeat, daemon=True)
+        self.thread.start()
+
+    # Releases the uncommitted leases, so that other hosts may take them right away
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        for repo in self.held:
+            fname = os.path.join(self.path, LEDGER_LEASE_NAME % repo)
+            if self._read(fname) == self.host:
+                os.remove(fname)
+        self.held.clear()
+        try:
+            os.remove(os.path.join(self.path, LEDGER_ALIVE_NAME % (self.host,)))
+        except FileNotFoundError:
+            pass
+
+    def lock(self):
+        fname = os.path.join(self.path, LEDGER_LOCK_NAME)
+        while True:
+            try:
+                fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(fname)
+                except FileNotFoundError:
+                    continue
+                if age > self.lease_time:
+                    # Writing the index takes far less than that, the holder has died
+                    print('Breaking stale index lock held by %s' % (self._read(fname),))
+                    try:
+                        os.remove(fname)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                time.sleep(LEDGER_POLL)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.host)
+            return
+
+    def unlock(self):
+        os.remove(os.path.join(self.path, LEDGER_LOCK_NAME))
+
+def open_ledger():
+    if not options.ledger:
+        return None
+    host = options.host_id
+    if not host:
+        # Unique per process, as two processes on one host must not share shards or leases
+        import socket
+        host = '%s-%d' % (socket.gethostname(), os.getpid())
+    return Ledger(os.path.join(options.data, options.ledger), fileify(host), options.lease_time)
             
 def cmd_genindex():
     init_index(True)
@@ -1014,11 +3056,36 @@ def cmd_acquire(dname, *repos_str):
     init_github_api()
 
     if not repos:
-        idx.files.pop(dname, None)
+        idx.removefiles({dname})
         acquire_metadata(fname, repos, idx, force_if_empty=True)
     else:
         acquire_metadata(fname, repos, idx)
 
+def cmd_reparse(dname, *repos_str):
+    data_dir = options.data
+
+    if not dname.endswith('.alarm.gz'):
+        print('Warning: %s does not end with .alarm.gz, adding it' % (dname,))
+        dname += '.alarm.gz'
+    fname = os.path.join(data_dir, dname)
+
+    spool = open_spool()
+    if spool is None:
+        die('No spool directory given, see --spool')
+        
+    repos = []
+    for i in repos_str:
+        on = tuple(i.split('/'))
+        if len(on) != 2:
+            die('Each repository must be in the form <owner>/<name>, got %s' % (i,))
+        repos.append(on)
+    if not repos:
+        repos = spool.repos()
+        print('Found %d repositories in the spool' % (len(repos),))
+
+    idx = init_index()
+    acquire_metadata(fname, repos, idx, fetch=spool.open)
+
 def read_repofile(fname):
     repos = []
     with open(fname, 'r') as f:
@@ -1054,6 +3121,138 @@ def cmd_acquire_files(dname, *repos_file):
 
     acquire_metadata(fname, repos, idx)
         
+DAEMON_POLL_INTERVAL = 2 # seconds
+DAEMON_DEFAULT_SIZE = 2**20 # assumed size of a repository, if the API did not tell us
+
+# A .lst repofile in the queue directory. The lines '#priority <n>' (higher first) and
+# '#target <file>' are comments, so it can be used with acquire_files as well.
+class Queue_job:
+    def __init__(self, fname):
+        self.fname = fname
+        self.name = os.path.basename(fname)[:-len('.lst')]
+        self.priority = 0
+        self.target = self.name
+        self.mtime = os.path.getmtime(fname)
+        
+        with open(fname, 'r') as f:
+            for l in f:
+                l = l.split()
+                if len(l) == 2 and l[0] == '#priority':
+                    self.priority = int(l[1])
+                elif len(l) == 2 and l[0] == '#target':
+                    self.target = l[1]
+        if not self.target.endswith('.alarm.gz'):
+            self.target += '.alarm.gz'
+        self.repos = read_repofile(fname)
+
+    def expected_size(self, idx):
+        return sum(global_repo_sizes.get(i, DAEMON_DEFAULT_SIZE) for i in self.repos
+            if i not in idx.repos)
+
+    def set_status(self, **kwargs):
+        # Written next to the job, as <name>.status
+        fname = self.fname[:-len('.lst')] + '.status'
+        data = {'target': self.target, 'priority': self.priority, 'repos': len(self.repos)}
+        data.update(kwargs)
+        with open(fname + '.tmp', 'w') as f:
+            f.write(json.dumps(data, indent=4))
+        os.replace(fname + '.tmp', fname)
+
+def scan_queue(queue_dir):
+    jobs = []
+    for i in sorted(os.listdir(queue_dir)):
+        fname = os.path.join(queue_dir, i)
+        if not i.endswith('.lst') or not os.path.isfile(fname):
+            continue
+        try:
+            jobs.append(Queue_job(fname))
+        except (ValueError, OSError) as e:
+            print('Could not read job %s: %s' % (fname, e))
+            os.replace(fname, fname + '.failed')
+        except SystemExit as e:
+            # read_repofile calls die on malformed lines, see run_queue_job
+            if e.code != 3: raise
+            os.replace(fname, fname + '.failed')
+    return jobs
+
+def run_queue_job(job, idx):
+    print('Starting job %s (%d repositories, priority %d)' % (job.name, len(job.repos), job.priority))
+    time_start = time.time()
+    job.set_status(state='running', started=time_start)
+    
+    state, error, acquired = 'done', None, []
+    try:
+        acquired = acquire_metadata(os.path.join(options.data, job.target), job.repos, idx)
+        if global_stop_flag and any(i not in idx.repos for i in job.repos):
+            state = 'interrupted'
+    except SystemExit as e:
+        # die was called, the message has been printed already. Anything else (e.g. pressing Ctrl+C
+        # twice) still stops the daemon.
+        if e.code != 3: raise
+        state, error = 'failed', 'exit code %d' % (e.code,)
+    except Exception as e:
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        state, error = 'failed', '%s: %s' % (type(e).__name__, e)
+
+    job.set_status(state=state, started=time_start, finished=time.time(), acquired=len(acquired),
+        error=error)
+    if state != 'interrupted':
+        # Interrupted jobs stay in the queue, and continue on the next start
+        os.replace(job.fname, job.fname + '.' + state)
+    print('Finished job %s: %s (%.02fs)' % (job.name, state, time.time() - time_start))
+
+def cmd_daemon(queue_dir):
+    global global_connections
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        print('%s does not exist, will be created' % (data_dir,))
+        os.makedirs(data_dir)
+    if not os.path.isdir(queue_dir):
+        print('%s does not exist, will be created' % (queue_dir,))
+        os.makedirs(queue_dir)
+
+    # All of this stays around between jobs: the index, the API token and limits, idle connections,
+    # prefetched tree information and the planner.
+    global_connections = {}
+    idx = init_index()
+    idx_mtime = os.path.getmtime(idx.fname) if os.path.isfile(idx.fname) else None
+    init_github_api()
+    planner_fname = os.path.join(options.data, PLANNER_STATE_NAME)
+    global global_planner
+    global_planner = Have_planner(planner_fname)
+
+    print('Waiting for jobs in %s (press Ctrl+C to stop)' % (queue_dir,))
+    try:
+        while not global_stop_flag:
+            jobs = scan_queue(queue_dir)
+            if not jobs:
+                time.sleep(DAEMON_POLL_INTERVAL)
+                continue
+            
+            # Someone else may have written the index in the meantime
+            mtime = os.path.getmtime(idx.fname) if os.path.isfile(idx.fname) else None
+            if mtime != idx_mtime:
+                print('Index has changed on disk, reloading')
+                idx = init_index()
+
+            # Getting the tree information (and sizes) for all queued repositories at once saves
+            # requests, and lets us run small jobs first
+            prefetch_trees([i for j in jobs for i in j.repos if i not in idx.repos])
+            
+            job = min(jobs, key=lambda j: (-j.priority, j.expected_size(idx), j.mtime))
+            run_queue_job(job, idx)
+            global_planner.save()
+            idx_mtime = os.path.getmtime(idx.fname) if os.path.isfile(idx.fname) else None
+    finally:
+        global_planner.report()
+        global_planner.save()
+        for conns in global_connections.values():
+            for conn in conns:
+                conn.close()
+        global_connections = None
+
 def cmd_by_language(lang_file):
     data_dir = options.data
     
@@ -1077,7 +3276,7 @@ def cmd_by_language(lang_file):
         
         if global_stop_flag: break
 
-def cmd_small(startpage=1):
+def cmd_small(checkpoint=SMALL_CHECKPOINT_NAME):
     data_dir = options.data
 
     if not os.path.exists(data_dir):
@@ -1087,14 +3286,23 @@ def cmd_small(startpage=1):
     idx = init_index()
     init_github_api()
 
-    page = int(startpage)
+    crawler = Small_crawler(os.path.join(data_dir, checkpoint))
+    t = threading.Thread(target=crawler.run, daemon=True)
+    t.start()
+
     while True:
-        repos = get_small_repos(page)
-        dname = 'small_page%d.alarm.gz' % (d,)
+        item = crawler.queue.get()
+        if item is None:
+            if not crawler.state['todo']:
+                print('Searched all partitions.')
+            break
+        part, page, repos = item
+        
+        dname = 'small_page%d.alarm.gz' % (crawler.state['batch'],)
         acquire_metadata(os.path.join(data_dir, dname), repos, idx)
+        crawler.done(part, page)
         
         if global_stop_flag: break
-        page += 1
 
 def cmd_list_contents(outfile, *dnames):
     data_dir = options.data
@@ -1119,7 +3327,7 @@ def cmd_list_contents(outfile, *dnames):
                 print('Warning: %s does not end with .alarm.gz, adding it' % (dname,))
                 dname += '.alarm.gz'
             fname = os.path.join(data_dir, dname)
-            f2 = gzip.open(fname, 'rb')
+            f2 = open_alarmfile(fname)
             
             if dname in idx.files:
                 print('File %s is in the index' % (dname,))
@@ -1138,14 +3346,98 @@ def cmd_list_contents(outfile, *dnames):
                 f.write('%s/%s\n' % i)
     print('Wrote %d repositories.' % (counter,))
 
-def init_tags(idx):
-    tags = {}
-    for fname in glob.glob(os.path.join(options.classes, '*.lst')):
-        tag = os.path.basename(fname)[:-4]
-        tags[tag] = set(read_repofile(fname))
-    for repo in idx.repos:
-        tags['repo_' + '/'.join(repo)] = {repo}
-    return tags
+TAG_CACHE_NAME = 'tags.cache'
+
+# Tags as bitsets over the sorted indexed repositories, cached in the data directory. The cache
+# is dropped whenever the set of repositories changes.
+class Tag_index:
+    def __init__(self, idx):
+        self.repos = sorted(idx.repos)
+        self.ids = {repo: i for i, repo in enumerate(self.repos)}
+        self.all = (1 << len(self.repos)) - 1
+        self.tags = {}
+        
+        self.fname = os.path.join(options.data, TAG_CACHE_NAME)
+        h = hashlib.sha1('\n'.join('/'.join(i) for i in self.repos).encode('utf-8'))
+        self.key = h.hexdigest()
+
+        cache = {}
+        if os.path.isfile(self.fname):
+            with open(self.fname, 'r') as f:
+                data = json.loads(f.read())
+            if data['key'] == self.key:
+                cache = data['tags']
+
+        changed = False
+        nbytes = (len(self.repos) + 7) // 8
+        for fname in glob.glob(os.path.join(options.classes, '*.lst')):
+            tag = os.path.basename(fname)[:-4]
+            mtime = os.path.getmtime(fname)
+            if tag in cache and cache[tag][0] == mtime:
+                b = zlib.decompress(bytes.fromhex(cache[tag][1]))
+                self.tags[tag] = int.from_bytes(b, byteorder='little')
+            else:
+                print('Updating tag %s...' % (tag,))
+                # Setting bits of an int one at a time would copy it each time
+                bits = bytearray(nbytes)
+                for repo in read_repofile(fname):
+                    i = self.ids.get(repo)
+                    if i is not None:
+                        bits[i >> 3] |= 1 << (i & 7)
+                self.tags[tag] = int.from_bytes(bits, byteorder='little')
+                cache[tag] = mtime, zlib.compress(bits).hex()
+                changed = True
+
+        for tag in list(cache):
+            if tag not in self.tags:
+                del cache[tag]
+                changed = True
+
+        if changed:
+            fname_tmp = self.fname + '.tmp'
+            with open(fname_tmp, 'w') as f:
+                f.write(json.dumps({'key': self.key, 'tags': cache}))
+            os.replace(fname_tmp, self.fname)
+
+    def tag(self, tag):
+        if tag.startswith('repo_'):
+            repo = tuple(tag[len('repo_'):].split('/'))
+            if repo in self.ids:
+                return 1 << self.ids[repo]
+        elif tag in self.tags:
+            return self.tags[tag]
+        die('Tag %s is unknown.' % (tag,))
+
+    # Each term is a ','-separated list of tags of which one has to match, '!' negates it
+    def query(self, terms):
+        bits = self.all
+        for term in terms:
+            neg = term.startswith('!')
+            if neg:
+                term = term[1:]
+            b = 0
+            for tag in term.split(','):
+                b |= self.tag(tag)
+            bits &= ~b if neg else b
+        return bits
+
+    def select(self, bits):
+        s = bin(bits)[:1:-1]
+        result = []
+        i = s.find('1')
+        while i != -1:
+            result.append(self.repos[i])
+            i = s.find('1', i + 1)
+        return result
+
+def select_repos(idx, tag_filter):
+    tags = Tag_index(idx)
+    repos = tags.select(tags.query(tag_filter))
+    infiles = sorted({idx.repos[repo] for repo in repos})
+
+    print('Found %d repositories, from %d data files' % (len(repos), len(infiles)))
+
+    return repos, infiles
 
 def cmd_graph_job(outfile, *tag_filter):
     data_dir = options.data
@@ -1154,26 +3446,10 @@ def cmd_graph_job(outfile, *tag_filter):
         die('The data directory (%s) does not exist!' % (data_dir,))
         
     idx = init_index()
-    tags = init_tags(idx)
-
-    for tag in tag_filter:
-        if tag not in tags:
-            die('Tag %s is unknown.' % (tag,))
-            
-    repos = set()
-    infiles = set()
-    for repo, dname in idx.repos.items():
-        if all(repo in tags[tag] for tag in tag_filter):
-            repos.add(repo)
-            infiles.add(dname)
-
-    print('Found %d repositories, from %d data files' % (len(repos), len(infiles)))
+    repos, infiles = select_repos(idx, tag_filter)
 
     f = open(outfile, 'w')
 
-    repos   = sorted(list(repos  ))
-    infiles = sorted(list(infiles))
-
     f.write('alarm_jobfile_header %s %s\n' % (len(repos), len(infiles)))
     for repo in repos:
         f.write('repo %s/%s\n' % repo)
@@ -1183,6 +3459,1433 @@ def cmd_graph_job(outfile, *tag_filter):
     
     f.close()
 
+# Graphfiles and commitfiles share the same layout: a header, a table of chunks, and the chunks
+CHUNKED_HEAD = struct.Struct('<4sIIII') # magic, version, number of repositories, of items, of chunks
+CHUNKED_ENTRY = struct.Struct('<4sQQ') # name, offset, length
+
+def write_chunked_file(fname, magic, version, num_repos, num_items, chunks):
+    off = CHUNKED_HEAD.size + len(chunks) * CHUNKED_ENTRY.size
+
+    data = []
+    table = []
+    for name, c in chunks:
+        if isinstance(c, array.array):
+            if sys.byteorder != 'little':
+                c = array.array(c.typecode, c)
+                c.byteswap()
+            c = c.tobytes()
+        off += -off % 8 # keep everything aligned, for the benefit of mmap and numpy
+        table.append(CHUNKED_ENTRY.pack(name, off, len(c)))
+        data.append((off, c))
+        off += len(c)
+
+    with open(fname, 'wb') as f:
+        f.write(CHUNKED_HEAD.pack(magic, version, num_repos, num_items, len(chunks)))
+        for i in table:
+            f.write(i)
+        for off, c in data:
+            f.write(bytes(off - f.tell()))
+            f.write(c)
+
+# Maps a file written by write_chunked_file, arrays are numpy arrays if available, else memoryviews
+class Chunked_file:
+    _dtypes = {'I': '<u4', 'q': '<i8', 'h': '<i2'}
+    
+    def __init__(self, fname, magic, version):
+        import mmap
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.numpy = numpy
+        
+        self.f = open(fname, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic_f, version_f, self.num_repos, self.num_items, num_chunks = CHUNKED_HEAD.unpack_from(self.mm)
+        if magic_f != magic:
+            raise ValueError('%s has the wrong magic number' % (fname,))
+        if version_f != version:
+            raise ValueError('%s has unsupported version %d' % (fname, version_f))
+
+        self.chunks = {}
+        for i in range(num_chunks):
+            name, off, l = CHUNKED_ENTRY.unpack_from(self.mm, CHUNKED_HEAD.size + i * CHUNKED_ENTRY.size)
+            self.chunks[name] = memoryview(self.mm)[off:off+l]
+            
+        self.repos = [tuple(i.split('/')) for i in bytes(self.chunks[b'REPN']).decode('utf-8')
+            .split('\0')] if self.num_repos else []
+        self.repo_ranges = self.ints(b'REPR') if b'REPR' in self.chunks else None
+
+    def ints(self, name, typecode='I'):
+        c = self.chunks[name]
+        if self.numpy is not None:
+            return self.numpy.frombuffer(c, dtype=self._dtypes[typecode])
+        if sys.byteorder != 'little':
+            a = array.array(typecode, c)
+            a.byteswap()
+            return memoryview(a)
+        return c.cast(typecode)
+
+    def find_repo(self, owner, repo):
+        i = self.repos.index((owner, repo))
+        return int(self.repo_ranges[2*i]), int(self.repo_ranges[2*i+1])
+
+    def close(self):
+        # numpy arrays and memoryviews keep the mapping alive, so they have to go first
+        for k in list(vars(self)):
+            if k not in ('f', 'mm', 'repos', 'num_repos', 'num_items'):
+                setattr(self, k, None)
+        self.mm.close()
+        self.f.close()
+
+GRAPHFILE_VERSION = 1
+GRAPH_NONE = 0xffffffff # parent that is not contained in the repository
+
+# Generation numbers and interval labels of the commits first to end, which have no parents
+# outside (see Graph format in the README). Returns (generation, post, low).
+def graph_labels(parent_offsets, parent_targets, first, end):
+    n = end - first
+    gen, post, low = (array.array('I', bytes(4 * n)) for _ in range(3))
+    seen = bytearray(n)
+    counter = first
+    for root in range(first, end):
+        if seen[root - first]: continue
+        seen[root - first] = 1
+        low[root - first] = counter
+        stack = [(root, parent_offsets[root])]
+        while stack:
+            node, i = stack[-1]
+            if i < parent_offsets[node+1]:
+                stack[-1] = node, i + 1
+                p = parent_targets[i]
+                if p != GRAPH_NONE and not seen[p - first]:
+                    seen[p - first] = 1
+                    low[p - first] = counter
+                    stack.append((p, parent_offsets[p]))
+                continue
+
+            # All parents are done
+            stack.pop()
+            g = 0
+            for p in parent_targets[parent_offsets[node]:parent_offsets[node+1]]:
+                if p != GRAPH_NONE and gen[p - first] > g:
+                    g = gen[p - first]
+            gen[node - first] = g + 1
+            post[node - first] = counter
+            counter += 1
+    return gen, post, low
+
+# Commits get dense ids within each repository, the parent edges are stored in CSR form
+class Graph_writer:
+    def __init__(self):
+        self.repos = []
+        self.repo_ranges = array.array('I')
+        self.commit_sha = bytearray()
+        self.commit_tree = array.array('I')
+        self.tree_ids = {}
+        self.tree_sha = bytearray()
+        self.parent_offsets = array.array('I', [0])
+        self.parent_targets = array.array('I')
+        self.generation = array.array('I')
+        self.post = array.array('I')
+        self.low = array.array('I')
+
+    # commits is a list of (sha, Commit) pairs with hex hashes
+    def add_repo(self, owner, repo, commits):
+        first = len(self.commit_tree)
+        ids = {sha: first + i for i, (sha, _) in enumerate(commits)}
+
+        for sha, c in commits:
+            self.commit_sha += bytes.fromhex(sha.decode('ascii'))
+
+            tree = bytes.fromhex(c.tree.decode('ascii'))
+            if tree not in self.tree_ids:
+                self.tree_ids[tree] = len(self.tree_ids)
+                self.tree_sha += tree
+            self.commit_tree.append(self.tree_ids[tree])
+
+            self.parent_targets.extend(ids.get(p, GRAPH_NONE) for p in c.parents)
+            self.parent_offsets.append(len(self.parent_targets))
+
+        for a, b in zip((self.generation, self.post, self.low), graph_labels(self.parent_offsets,
+                self.parent_targets, first, len(self.commit_tree))):
+            a += b
+
+        self.repos.append('%s/%s' % (owner, repo))
+        self.repo_ranges.append(first)
+        self.repo_ranges.append(len(self.commit_tree))
+
+    def chunks(self):
+        # Subclasses (or later versions) may add more chunks here
+        return [
+            (b'REPN', '\0'.join(self.repos).encode('utf-8')),
+            (b'REPR', self.repo_ranges),
+            (b'CSHA', self.commit_sha),
+            (b'CTRE', self.commit_tree),
+            (b'TSHA', self.tree_sha),
+            (b'POFF', self.parent_offsets),
+            (b'PTGT', self.parent_targets),
+            (b'GENR', self.generation),
+            (b'POST', self.post),
+            (b'PLOW', self.low),
+        ]
+
+    def write(self, fname):
+        write_chunked_file(fname, GRAPHFILE_MAGIC, GRAPHFILE_VERSION, len(self.repos),
+            len(self.commit_tree), self.chunks())
+
+# Answers reachability queries via the labels of graph_labels
+class Graph_file(Chunked_file):
+    def __init__(self, fname):
+        super().__init__(fname, GRAPHFILE_MAGIC, GRAPHFILE_VERSION)
+        self.num_commits = self.num_items
+        self.commit_tree    = self.ints(b'CTRE')
+        self.parent_offsets = self.ints(b'POFF')
+        self.parent_targets = self.ints(b'PTGT')
+        self.commit_sha_raw = self.chunks[b'CSHA']
+        self.tree_sha_raw   = self.chunks[b'TSHA']
+        self.ids = None
+
+        if b'GENR' in self.chunks:
+            self.generation = self.ints(b'GENR')
+            self.post       = self.ints(b'POST')
+            self.low        = self.ints(b'PLOW')
+        else:
+            # Written by an older version, compute them now
+            self.generation, self.post, self.low = array.array('I'), array.array('I'), array.array('I')
+            for i in range(self.num_repos):
+                for a, b in zip((self.generation, self.post, self.low), graph_labels(
+                        self.parent_offsets, self.parent_targets, *self.repo_range(i))):
+                    a += b
+
+    def repo_range(self, i):
+        return int(self.repo_ranges[2*i]), int(self.repo_ranges[2*i+1])
+
+    def parents(self, node):
+        return self.parent_targets[self.parent_offsets[node]:self.parent_offsets[node+1]]
+
+    # Whether a is reachable from b, including a == b
+    def is_ancestor(self, a, b):
+        gen, post, low = self.generation, self.post, self.low
+        if a == b:
+            return True
+        ga, pa = gen[a], post[a]
+        if ga >= gen[b]:
+            return False
+        if low[b] <= pa <= post[b]:
+            return True
+
+        # Anything with a generation of at most ga cannot reach a, except a itself
+        stack = [b]
+        seen = {b}
+        while stack:
+            for p in self.parents(stack.pop()).tolist():
+                if p == a:
+                    return True
+                if p == GRAPH_NONE or p in seen or gen[p] <= ga: continue
+                if low[p] <= pa <= post[p]:
+                    return True
+                seen.add(p)
+                stack.append(p)
+        return False
+
+    def _paint(self, a, b, stop, visit):
+        # Walk the ancestors of a and b, children before parents (by generation), marking each
+        # commit with 1 if a reaches it, and 2 if b does. The flags of a commit are final once it is
+        # taken from the heap, then visit(node, flags) returns the flags passed on to its parents.
+        # The walk ends when all commits left have flags for which stop is true.
+        import heapq
+        gen = self.generation
+        flags = {a: 1}
+        flags[b] = flags.get(b, 0) | 2
+        heap = [(-int(gen[i]), i) for i in flags]
+        heapq.heapify(heap)
+        active = sum(not stop(f) for f in flags.values())
+        while active:
+            _, node = heapq.heappop(heap)
+            f = flags[node]
+            if not stop(f):
+                active -= 1
+            f = visit(node, f)
+            for p in self.parents(node).tolist():
+                if p == GRAPH_NONE: continue
+                old = flags.get(p)
+                new = (old or 0) | f
+                if old == new: continue
+                flags[p] = new
+                if old is None:
+                    heapq.heappush(heap, (-int(gen[p]), p))
+                    active += not stop(new)
+                elif stop(old) and not stop(new):
+                    active += 1
+                elif not stop(old) and stop(new):
+                    active -= 1
+
+    # As git merge-base --all
+    def merge_bases(self, a, b):
+        if self.is_ancestor(a, b):
+            return [a]
+        if self.is_ancestor(b, a):
+            return [b]
+
+        # 4 marks the ancestors of merge bases, which cannot be best anymore
+        result = []
+        def visit(node, f):
+            if f == 3:
+                result.append(node)
+                return f | 4
+            return f
+        self._paint(a, b, lambda f: f & 4, visit)
+        return result
+
+    # As git rev-list --count a..b
+    def count_between(self, a, b):
+        result = []
+        def visit(node, f):
+            if f == 2:
+                result.append(node)
+            return f
+        self._paint(a, b, lambda f: f != 2, visit)
+        return len(result)
+
+    def commit_sha(self, node):
+        return self.commit_sha_raw[20*node:20*node+20].hex().encode('ascii')
+
+    def tree_sha(self, node):
+        i = int(self.commit_tree[node])
+        return self.tree_sha_raw[20*i:20*i+20].hex().encode('ascii')
+
+    # Id of the commit sha, which may occur in several repositories, repo_range restricts the search
+    def node(self, sha, repo_range=None):
+        lo, hi = repo_range or (0, self.num_commits)
+        if self.ids is None:
+            self.ids = defaultdict(list)
+            raw = self.commit_sha_raw
+            for i in range(self.num_commits):
+                self.ids[raw[20*i:20*i+20].tobytes()].append(i)
+        for i in self.ids.get(bytes.fromhex(sha.decode('ascii')), ()):
+            if lo <= i < hi:
+                return i
+        raise KeyError(sha)
+
+def cmd_write_graphs(outfile, *tag_filter):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+        
+    idx = init_index()
+    repos, infiles = select_repos(idx, tag_filter)
+    repos = set(repos)
+    store = open_object_store(readonly=True)
+
+    g = Graph_writer()
+    try:
+        for dname in infiles:
+            fname = os.path.join(data_dir, dname)
+            print('Reading %s...' % (fname,))
+            with open_alarmfile(fname) as f:
+                for (owner, repo), it in read_alarmfile(f, store):
+                    if (owner, repo) not in repos:
+                        for _ in it: pass
+                        continue
+                    commits = [(sha, o) for sha, o in it if isinstance(o, Commit)]
+                    g.add_repo(owner, repo, commits)
+    finally:
+        if store is not None:
+            store.close()
+
+    print('Writing %d repositories, %d commits, %d edges to %s...'
+          % (len(g.repos), len(g.commit_tree), len(g.parent_targets), outfile))
+    g.write(outfile)
+
+COMMITFILE_MAGIC = b'3\x8c\x1e\x5b'
+COMMITFILE_VERSION = 1
+
+# Interned author and committer ids, 64-bit timestamps and 16-bit timezones (in minutes)
+class Commit_table_writer:
+    def __init__(self):
+        self.repos = []
+        self.repo_ranges = array.array('I')
+        self.commit_sha = bytearray()
+        self.idents = {}
+        self.author = array.array('I')
+        self.author_time = array.array('q')
+        self.author_tz = array.array('h')
+        self.committer = array.array('I')
+        self.committer_time = array.array('q')
+        self.committer_tz = array.array('h')
+
+    def intern(self, ident):
+        i = self.idents.get(ident)
+        if i is None:
+            i = self.idents[ident] = len(self.idents)
+        return i
+    
+    # commits is a list of (sha, Commit_meta) pairs with hex hashes
+    def add_repo(self, owner, repo, commits):
+        self.repos.append('%s/%s' % (owner, repo))
+        self.repo_ranges.append(len(self.author))
+        for sha, c in commits:
+            self.commit_sha += bytes.fromhex(sha.decode('ascii'))
+            self.author.append(self.intern(c.author))
+            self.author_time.append(c.author_time)
+            self.author_tz.append(c.author_tz)
+            self.committer.append(self.intern(c.committer))
+            self.committer_time.append(c.committer_time)
+            self.committer_tz.append(c.committer_tz)
+        self.repo_ranges.append(len(self.author))
+
+    def write(self, fname):
+        write_chunked_file(fname, COMMITFILE_MAGIC, COMMITFILE_VERSION, len(self.repos),
+            len(self.author), [
+                (b'REPN', '\0'.join(self.repos).encode('utf-8')),
+                (b'REPR', self.repo_ranges),
+                (b'CSHA', self.commit_sha),
+                (b'IDNT', b'\0'.join(self.idents)),
+                (b'AUTH', self.author),
+                (b'ATIM', self.author_time),
+                (b'ATZO', self.author_tz),
+                (b'CMTR', self.committer),
+                (b'CTIM', self.committer_time),
+                (b'CTZO', self.committer_tz),
+            ])
+
+# author and committer are indices into idents
+class Commit_table(Chunked_file):
+    def __init__(self, fname):
+        super().__init__(fname, COMMITFILE_MAGIC, COMMITFILE_VERSION)
+        self.num_commits = self.num_items
+        self.commit_sha_raw = self.chunks[b'CSHA']
+        self.idents = bytes(self.chunks[b'IDNT']).split(b'\0')
+        self.author         = self.ints(b'AUTH')
+        self.author_time    = self.ints(b'ATIM', 'q')
+        self.author_tz      = self.ints(b'ATZO', 'h')
+        self.committer      = self.ints(b'CMTR')
+        self.committer_time = self.ints(b'CTIM', 'q')
+        self.committer_tz   = self.ints(b'CTZO', 'h')
+
+    def commit_sha(self, i):
+        return self.commit_sha_raw[20*i:20*i+20].hex().encode('ascii')
+
+def commitfile_name(fname):
+    return fname[:-len('.alarm.gz')] + '.commits'
+
+def cmd_extract_commits(*dnames):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+    store = open_object_store(readonly=True)
+
+    try:
+        for fname in fnames:
+            out = commitfile_name(fname)
+            if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(fname):
+                print('%s is up to date' % (out,))
+                continue
+            
+            print('Extracting commits from %s...' % (fname,))
+            t = Commit_table_writer()
+            with open_alarmfile(fname) as f:
+                for (owner, repo), it in read_alarmfile(f, store, classes=(Commit_meta, Blob)):
+                    t.add_repo(owner, repo, [(sha, o) for sha, o in it if isinstance(o, Commit_meta)])
+                    
+            print('Writing %d repositories, %d commits, %d identities to %s...'
+                  % (len(t.repos), len(t.author), len(t.idents), out))
+            t.write(out + '.tmp')
+            os.replace(out + '.tmp', out)
+            
+            if global_stop_flag: break
+    finally:
+        if store is not None:
+            store.close()
+
+PATHFILE_MAGIC = b'4\x5a\x3f\x81'
+PATHFILE_VERSION = 1
+PATH_BLOOM_BITS = 10   # bits per changed path, as in git's commit-graph
+PATH_BLOOM_HASHES = 7
+PATH_BLOOM_MAX = 512   # commits that change more paths get a filter that matches everything
+PATH_BLOOM_ALL = b'\xff'
+
+# Paths differing between the trees a and b (None for empty) and their directories. None if a tree
+# is missing or there are more than PATH_BLOOM_MAX.
+def changed_paths(trees, a, b, prefix=b''):
+    if (a is not None and a not in trees) or (b is not None and b not in trees):
+        return None
+    old = {name: (mode, sha) for mode, name, sha in trees[a].entries} if a is not None else {}
+    new = {name: (mode, sha) for mode, name, sha in trees[b].entries} if b is not None else {}
+    
+    result = []
+    for name in old.keys() | new.keys():
+        x, y = old.get(name), new.get(name)
+        if x == y: continue
+        path = prefix + name
+        result.append(path)
+
+        sub_a = x[1] if x is not None and x[0] == b'40000' else None
+        sub_b = y[1] if y is not None and y[0] == b'40000' else None
+        if sub_a is not None or sub_b is not None:
+            sub = changed_paths(trees, sub_a, sub_b, path + b'/')
+            if sub is None:
+                return None
+            result += sub
+        if len(result) > PATH_BLOOM_MAX:
+            return None
+    return result
+
+def path_bloom_bits(path, nbits):
+    # Double hashing, the two halves of the digest give the start and the step
+    h1, h2 = struct.unpack('<II', hashlib.blake2b(path, digest_size=8).digest())
+    return [(h1 + i * h2) % nbits for i in range(PATH_BLOOM_HASHES)]
+
+# Bloom filters of the paths each commit changed relative to its first parent (see Path format in
+# the README)
+class Path_filter_writer:
+    def __init__(self):
+        self.repos = []
+        self.repo_ranges = array.array('I')
+        self.commit_sha = bytearray()
+        self.filter_end = array.array('q', [0])
+        self.filters = bytearray()
+        self.num_all = 0
+
+    # commits is a list of (sha, Commit) pairs, trees maps hex hashes to Tree
+    def add_repo(self, owner, repo, commits, trees):
+        self.repos.append('%s/%s' % (owner, repo))
+        self.repo_ranges.append(len(self.filter_end) - 1)
+        by_sha = dict(commits)
+        for sha, c in commits:
+            self.commit_sha += bytes.fromhex(sha.decode('ascii'))
+            if not c.parents:
+                paths = changed_paths(trees, None, c.tree)
+            elif c.parents[0] in by_sha:
+                paths = changed_paths(trees, by_sha[c.parents[0]].tree, c.tree)
+            else:
+                paths = None
+
+            if paths is None:
+                self.filters += PATH_BLOOM_ALL
+                self.num_all += 1
+            elif paths:
+                bits = bytearray((len(paths) * PATH_BLOOM_BITS + 7) // 8)
+                for p in paths:
+                    for i in path_bloom_bits(p, len(bits) * 8):
+                        bits[i >> 3] |= 1 << (i & 7)
+                self.filters += bits
+            self.filter_end.append(len(self.filters))
+        self.repo_ranges.append(len(self.filter_end) - 1)
+
+    def write(self, fname):
+        write_chunked_file(fname, PATHFILE_MAGIC, PATHFILE_VERSION, len(self.repos),
+            len(self.filter_end) - 1, [
+                (b'REPN', '\0'.join(self.repos).encode('utf-8')),
+                (b'REPR', self.repo_ranges),
+                (b'CSHA', self.commit_sha),
+                (b'BIDX', self.filter_end),
+                (b'BDAT', self.filters),
+            ])
+
+# Commits are in the same order as in the alarmfile and the commitfile
+class Path_filter(Chunked_file):
+    def __init__(self, fname):
+        super().__init__(fname, PATHFILE_MAGIC, PATHFILE_VERSION)
+        self.num_commits = self.num_items
+        self.commit_sha_raw = self.chunks[b'CSHA']
+        self.filter_end = self.ints(b'BIDX', 'q')
+        self.filters = self.chunks[b'BDAT']
+
+    def commit_sha(self, i):
+        return self.commit_sha_raw[20*i:20*i+20].hex().encode('ascii')
+
+    # path is bytes without leading or trailing slashes, True may be a false positive
+    def maybe_changed(self, i, path):
+        bits = self.filters[self.filter_end[i]:self.filter_end[i+1]]
+        if not len(bits):
+            return False
+        # The directories containing path have changed as well, checking them filters out more
+        p = -1
+        while True:
+            p = path.find(b'/', p + 1)
+            for j in path_bloom_bits(path[:p] if p != -1 else path, len(bits) * 8):
+                if not bits[j >> 3] & 1 << (j & 7):
+                    return False
+            if p == -1:
+                return True
+
+    # The others certainly have the same entry for path as their first parent
+    def candidates(self, owner, repo, path):
+        first, end = self.find_repo(owner, repo)
+        return [i for i in range(first, end) if self.maybe_changed(i, path)]
+
+def pathfile_name(fname):
+    return fname[:-len('.alarm.gz')] + '.paths'
+
+def cmd_extract_paths(*dnames):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+    store = open_object_store(readonly=True)
+
+    try:
+        for fname in fnames:
+            out = pathfile_name(fname)
+            if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(fname):
+                print('%s is up to date' % (out,))
+                continue
+            
+            print('Extracting changed paths from %s...' % (fname,))
+            w = Path_filter_writer()
+            with open_alarmfile(fname) as f:
+                for (owner, repo), it in read_alarmfile(f, store):
+                    commits = []
+                    trees = {}
+                    for sha, o in it:
+                        if isinstance(o, Commit):
+                            commits.append((sha, o))
+                        elif isinstance(o, Tree):
+                            trees[sha] = o
+                    w.add_repo(owner, repo, commits, trees)
+                    
+            print('Writing %d repositories, %d commits (%d without filter), %.1f KiB of filters to %s...'
+                  % (len(w.repos), len(w.filter_end) - 1, w.num_all, len(w.filters) / 1024, out))
+            w.write(out + '.tmp')
+            os.replace(out + '.tmp', out)
+            
+            if global_stop_flag: break
+    finally:
+        if store is not None:
+            store.close()
+
+TREEFILE_MAGIC = b'5\x1d\x6b\x92'
+TREEFILE_VERSION = 1
+
+# Names and objects are interned per file, modes use global_tree_dictionary
+class Tree_table_writer:
+    def __init__(self):
+        self.repos = []
+        self.repo_ranges = array.array('I')
+        self.tree_sha = bytearray()
+        self.tree_start = array.array('I', [0])
+        self.names = {} # id in global_tree_dictionary -> id in this file
+        self.name_list = []
+        self.objects = {}
+        self.object_sha = bytearray()
+        self.entry_name = array.array('I')
+        self.entry_mode = array.array('I')
+        self.entry_object = array.array('I')
+
+    # trees is a list of (sha, Tree_columns) pairs with hex hashes
+    def add_repo(self, owner, repo, trees):
+        d = global_tree_dictionary
+        names = self.names
+        objects = self.objects
+        
+        self.repos.append('%s/%s' % (owner, repo))
+        self.repo_ranges.append(len(self.tree_start) - 1)
+        for sha, t in trees:
+            self.tree_sha += bytes.fromhex(sha.decode('ascii'))
+            for i in t.name_id:
+                j = names.get(i)
+                if j is None:
+                    j = names[i] = len(self.name_list)
+                    self.name_list.append(d.names[i])
+                self.entry_name.append(j)
+            self.entry_mode.extend(t.mode_id)
+            for k in range(0, len(t.shas), 20):
+                sha_obj = t.shas[k:k+20]
+                j = objects.get(sha_obj)
+                if j is None:
+                    j = objects[sha_obj] = len(objects)
+                    self.object_sha += sha_obj
+                self.entry_object.append(j)
+            self.tree_start.append(len(self.entry_name))
+        self.repo_ranges.append(len(self.tree_start) - 1)
+
+    def write(self, fname):
+        write_chunked_file(fname, TREEFILE_MAGIC, TREEFILE_VERSION, len(self.repos),
+            len(self.tree_start) - 1, [
+                (b'REPN', '\0'.join(self.repos).encode('utf-8')),
+                (b'REPR', self.repo_ranges),
+                (b'TSHA', self.tree_sha),
+                (b'TENT', self.tree_start),
+                (b'NAME', b'\0'.join(self.name_list)),
+                (b'MODE', b'\0'.join(global_tree_dictionary.modes)),
+                (b'ENAM', self.entry_name),
+                (b'EMOD', self.entry_mode),
+                (b'EOBJ', self.entry_object),
+                (b'OSHA', self.object_sha),
+            ])
+
+# The entries of tree i are the rows tree_start[i] to tree_start[i+1] of the entry_ columns, e.g.
+# (t.entry_name == t.name_id(b'README.md')).sum() with numpy
+class Tree_table(Chunked_file):
+    def __init__(self, fname):
+        super().__init__(fname, TREEFILE_MAGIC, TREEFILE_VERSION)
+        self.num_trees = self.num_items
+        self.tree_sha_raw = self.chunks[b'TSHA']
+        self.object_sha_raw = self.chunks[b'OSHA']
+        self.names = bytes(self.chunks[b'NAME']).split(b'\0')
+        self.modes = bytes(self.chunks[b'MODE']).split(b'\0')
+        self.tree_start   = self.ints(b'TENT')
+        self.entry_name   = self.ints(b'ENAM')
+        self.entry_mode   = self.ints(b'EMOD')
+        self.entry_object = self.ints(b'EOBJ')
+        self._name_ids = None
+
+    def tree_sha(self, i):
+        return self.tree_sha_raw[20*i:20*i+20].hex().encode('ascii')
+
+    def object_sha(self, j):
+        return self.object_sha_raw[20*j:20*j+20].hex().encode('ascii')
+
+    # None if no entry has this name
+    def name_id(self, name):
+        if self._name_ids is None:
+            self._name_ids = {j: i for i, j in enumerate(self.names)}
+        return self._name_ids.get(name)
+
+    # As (mode, name, sha) like Tree.entries
+    def entries(self, i):
+        return [(self.modes[self.entry_mode[k]], self.names[self.entry_name[k]],
+            self.object_sha(self.entry_object[k]))
+            for k in range(self.tree_start[i], self.tree_start[i+1])]
+
+def treefile_name(fname):
+    return fname[:-len('.alarm.gz')] + '.trees'
+
+def cmd_extract_trees(*dnames):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+    store = open_object_store(readonly=True)
+
+    try:
+        for fname in fnames:
+            out = treefile_name(fname)
+            if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(fname):
+                print('%s is up to date' % (out,))
+                continue
+            
+            print('Extracting trees from %s...' % (fname,))
+            t = Tree_table_writer()
+            with open_alarmfile(fname) as f:
+                # Commits become None, as Blob only keeps data if asked to
+                for (owner, repo), it in read_alarmfile(f, store, classes=(Blob, Tree_columns)):
+                    t.add_repo(owner, repo, [(sha, o) for sha, o in it if isinstance(o, Tree_columns)])
+                    
+            print('Writing %d repositories, %d trees, %d entries, %d names to %s...'
+                  % (len(t.repos), len(t.tree_start) - 1, len(t.entry_name), len(t.name_list), out))
+            t.write(out + '.tmp')
+            os.replace(out + '.tmp', out)
+            
+            if global_stop_flag: break
+    finally:
+        if store is not None:
+            store.close()
+
+# Random access into gzip files, see examples/zran.c in the zlib distribution. The zlib module does
+# not expose inflatePrime and Z_BLOCK, so we talk to libz directly.
+
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+ZRAN_WINSIZE = 32768
+ZRAN_CHUNK = 65536
+ZRAN_MEMBER = -1 # marks access points at the beginning of a gzip member
+
+global_libz = None
+
+def load_libz():
+    # This also makes ctypes and _z_stream available as globals, only readers with random access
+    # need them.
+    global global_libz, ctypes, _z_stream
+    if global_libz is None:
+        import ctypes
+        import ctypes.util
+        
+        class _z_stream(ctypes.Structure):
+            _fields_ = [
+                ('next_in',   ctypes.c_void_p),
+                ('avail_in',  ctypes.c_uint),
+                ('total_in',  ctypes.c_ulong),
+                ('next_out',  ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg',       ctypes.c_char_p),
+                ('state',     ctypes.c_void_p),
+                ('zalloc',    ctypes.c_void_p),
+                ('zfree',     ctypes.c_void_p),
+                ('opaque',    ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler',     ctypes.c_ulong),
+                ('reserved',  ctypes.c_ulong),
+            ]
+        
+        name = ctypes.util.find_library('z')
+        if name is None:
+            die('Could not find libz, which is needed for random access into alarmfiles')
+        global_libz = ctypes.CDLL(name)
+        global_libz.zlibVersion.restype = ctypes.c_char_p
+    return global_libz
+
+# Decompresses gzip from the beginning or an access point (out, in, bits, window), recording
+# access points about every span bytes of output if span is given
+class Zran_reader(io.RawIOBase):
+    def __init__(self, f, point=None, span=None):
+        self.z = load_libz()
+        self.f = f
+        self.strm = _z_stream()
+        self.inbuf = ctypes.create_string_buffer(ZRAN_CHUNK)
+        self.window = ctypes.create_string_buffer(ZRAN_WINSIZE)
+        self.winview = memoryview(self.window).cast('B')
+        self.wpos = 0
+        self.span = span
+        self.points = []
+        self.eof = False
+
+        out, in_, bits, window = point or (0, 0, ZRAN_MEMBER, b'')
+        self.totout = self.last = out
+        self.totin = in_
+        if bits == ZRAN_MEMBER:
+            self._init(31)
+            f.seek(in_)
+            if span is not None:
+                self.points.append((out, in_, ZRAN_MEMBER, b''))
+        else:
+            self._init(-15)
+            f.seek(in_ - (1 if bits else 0))
+            if bits:
+                self._check(self.z.inflatePrime(ctypes.byref(self.strm), bits, f.read(1)[0] >> (8 - bits)))
+            if window:
+                self._check(self.z.inflateSetDictionary(ctypes.byref(self.strm), window, len(window)))
+        self.raw = bits != ZRAN_MEMBER
+
+    def _init(self, wbits):
+        version = self.z.zlibVersion()
+        self._check(self.z.inflateInit2_(ctypes.byref(self.strm), wbits, version,
+            ctypes.sizeof(_z_stream)))
+
+    def _check(self, ret):
+        if ret < 0 and ret != Z_BUF_ERROR:
+            msg = self.strm.msg.decode('utf-8', 'replace') if self.strm.msg else 'error %d' % (ret,)
+            raise zlib.error('Error while decompressing: %s' % (msg,))
+        return ret
+
+    def _fill(self):
+        if not self.strm.avail_in:
+            num = self.f.readinto(memoryview(self.inbuf).cast('B'))
+            self.strm.next_in = ctypes.addressof(self.inbuf)
+            self.strm.avail_in = num
+        return self.strm.avail_in
+
+    def _snapshot(self):
+        w = self.winview
+        if self.totout >= ZRAN_WINSIZE:
+            return bytes(w[self.wpos:]) + bytes(w[:self.wpos])
+        return bytes(w[:self.wpos])
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        m = memoryview(buf).cast('B')
+        num = 0
+        while num < len(m) and not self.eof:
+            if not self._fill():
+                raise EOFError('Compressed file ended before the end of the stream')
+            if self.wpos == ZRAN_WINSIZE:
+                self.wpos = 0
+
+            want = min(ZRAN_WINSIZE - self.wpos, len(m) - num)
+            self.strm.next_out = ctypes.addressof(self.window) + self.wpos
+            self.strm.avail_out = want
+            avail_in = self.strm.avail_in
+            ret = self._check(self.z.inflate(ctypes.byref(self.strm), Z_BLOCK))
+            got = want - self.strm.avail_out
+            
+            m[num:num+got] = self.winview[self.wpos:self.wpos+got]
+            num += got
+            self.wpos += got
+            self.totout += got
+            self.totin += avail_in - self.strm.avail_in
+
+            if ret == Z_STREAM_END:
+                if self.raw:
+                    # Skip the gzip trailer, inflate only does that in gzip mode
+                    for _ in range(8):
+                        if not self._fill():
+                            raise EOFError('Compressed file ended in the gzip trailer')
+                        self.strm.next_in += 1
+                        self.strm.avail_in -= 1
+                        self.totin += 1
+                
+                # Continue with the next member, if there is one
+                if not self._fill():
+                    self.eof = True
+                    break
+                self._check(self.z.inflateReset2(ctypes.byref(self.strm), 31))
+                self.raw = False
+                if self.span is not None:
+                    self.points.append((self.totout, self.totin, ZRAN_MEMBER, b''))
+                    self.last = self.totout
+            elif (self.span is not None and self.strm.data_type & 128 and not self.strm.data_type & 64
+                    and self.totout - self.last > self.span):
+                self.points.append((self.totout, self.totin, self.strm.data_type & 7, self._snapshot()))
+                self.last = self.totout
+                
+        return num
+
+    def tell(self):
+        return self.totout
+
+    def skip(self, num):
+        buf = memoryview(global_64k_buffer)
+        while num > 0:
+            i = self.readinto(buf[:min(num, len(buf))])
+            if not i:
+                raise EOFError('Skipped past the end of the file')
+            num -= i
+
+    def close(self):
+        if not self.closed:
+            self.z.inflateEnd(ctypes.byref(self.strm))
+            self.f.close()
+        super().close()
+
+SEEKFILE_MAGIC = b'\x9d\x51\x0c\x3e'
+SEEKFILE_VERSION = 1
+
+def seekfile_name(fname):
+    return fname[:-len('.alarm.gz')] + '.seek'
+
+def write_seekfile(fname, out, span):
+    with open(fname, 'rb') as f:
+        r = Zran_reader(f, span=span)
+        if r.read(4) != ALARMFILE_MAGIC:
+            raise Pack_error('%s is not an alarmfile' % (fname,))
+        starts = []
+        repos, size = find_repos_and_offset(r, starts)
+        size += 4
+        points = r.points
+        r.close()
+
+    windows = bytearray()
+    offsets = array.array('q', [0])
+    for _, _, _, w in points:
+        windows += zlib.compress(w)
+        offsets.append(len(windows))
+        
+    write_chunked_file(out, SEEKFILE_MAGIC, SEEKFILE_VERSION, len(repos), len(points), [
+        (b'REPN', '\0'.join('%s/%s' % i for i in repos).encode('utf-8')),
+        (b'RPOS', array.array('q', [4 + i for i in starts])),
+        (b'FSIZ', array.array('q', [os.path.getsize(fname), size])),
+        (b'POUT', array.array('q', [i[0] for i in points])),
+        (b'PIN_', array.array('q', [i[1] for i in points])),
+        (b'PBIT', array.array('h', [i[2] for i in points])),
+        (b'WOFF', offsets),
+        (b'WIND', windows),
+    ])
+    return len(repos), len(points)
+
+# Access points and repository offsets of an alarmfile, see Seek format in the README
+class Seek_index(Chunked_file):
+    def __init__(self, fname):
+        super().__init__(fname, SEEKFILE_MAGIC, SEEKFILE_VERSION)
+        self.repo_pos  = self.ints(b'RPOS', 'q')
+        self.file_size, self.data_size = map(int, self.ints(b'FSIZ', 'q'))
+        self.point_out = self.ints(b'POUT', 'q')
+        self.point_in  = self.ints(b'PIN_', 'q')
+        self.point_bit = self.ints(b'PBIT', 'h')
+        self.win_off   = self.ints(b'WOFF', 'q')
+
+    def point(self, i):
+        w = self.chunks[b'WIND'][self.win_off[i]:self.win_off[i+1]]
+        return (int(self.point_out[i]), int(self.point_in[i]), int(self.point_bit[i]),
+            zlib.decompress(w) if len(w) else b'')
+
+    # Positioned at the uncompressed offset
+    def open(self, fname, offset):
+        if os.path.getsize(fname) != self.file_size:
+            raise ValueError('Seek index is out of date for %s' % (fname,))
+        # The last access point at or before offset
+        lo, hi = 0, self.num_items
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.point_out[mid] <= offset:
+                lo = mid
+            else:
+                hi = mid
+        point = self.point(lo)
+        r = Zran_reader(open(fname, 'rb'), point)
+        r.skip(offset - point[0])
+        return r
+
+    # Positioned at the header of the repository, read it with read_alarmfile(magic=False)
+    def open_repo(self, fname, owner, repo):
+        return self.open(fname, int(self.repo_pos[self.repos.index((owner, repo))]))
+
+    # At most num contiguous ranges of similar size, as (first, end) indices into self.repos
+    def split(self, num):
+        result = []
+        first = 0
+        for k in range(1, num + 1):
+            end = first
+            while end < self.num_repos and (k == num or self.repo_pos[end] < self.data_size * k / num):
+                end += 1
+            if end > first:
+                result.append((first, end))
+            first = end
+        return result
+
+def cmd_seekindex(*dnames):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+
+    for fname in fnames:
+        out = seekfile_name(fname)
+        if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(fname):
+            print('%s is up to date' % (out,))
+            continue
+
+        with open(fname, 'rb') as f:
+            if f.read(len(XZ_MAGIC)) == XZ_MAGIC:
+                print('Skipping %s, only gzip files are supported' % (fname,))
+                continue
+        
+        print('Building seek index for %s...' % (fname,))
+        num_repos, num_points = write_seekfile(fname, out + '.tmp', options.seek_span * 2**20)
+        os.replace(out + '.tmp', out)
+        print('Wrote %d repositories, %d access points to %s' % (num_repos, num_points, out))
+        
+        if global_stop_flag: break
+
+VERIFY_MAX_EXAMPLES = 5
+
+# Checks that the trees and parents the objects reference are in the repository (down to max_depth).
+# As these are hashes, this also catches changed objects.
+def verify_repo(it, max_depth=None):
+    have_commits, have_trees = set(), {} # tree -> its subtrees
+    want_commits, want_trees = [], [] # (sha, sha of the object referencing it)
+    for sha, o in it:
+        if isinstance(o, Commit):
+            have_commits.add(sha)
+            if max_depth != 0:
+                want_trees.append((o.tree, sha))
+            want_commits += [(i, sha) for i in o.parents]
+        else:
+            have_trees[sha] = [i[2] for i in o.entries if i[0] == b'40000']
+
+    if max_depth is None:
+        want_trees += [(i, sha) for sha, subtrees in have_trees.items() for i in subtrees]
+    else:
+        level = [i for i, _ in want_trees]
+        seen = set(level)
+        for _ in range(max_depth - 1):
+            level_next = []
+            for sha in level:
+                for i in have_trees.get(sha, ()):
+                    if i not in seen:
+                        seen.add(i)
+                        level_next.append(i)
+                        want_trees.append((i, sha))
+            level = level_next
+
+    missing_trees = [i for i in want_trees if i[0] not in have_trees]
+    missing_parents = [i for i in want_commits if i[0] not in have_commits]
+    examples = ['%s (referenced by %s)' % (i.decode('ascii'), j.decode('ascii'))
+        for i, j in (missing_trees + missing_parents)[:VERIFY_MAX_EXAMPLES]]
+    return {'commits': len(have_commits), 'trees': len(have_trees),
+        'missing_trees': len(missing_trees), 'missing_parents': len(missing_parents),
+        'missing': examples}
+
+# Runs in a worker of cmd_verify, starting at the uncompressed offset pos
+def verify_task(fname, store_path, pos=None, count=None):
+    result = {'repos': [], 'starts': [], 'error': None}
+    name = None
+    store = Object_store(store_path, readonly=True) if store_path else None
+    try:
+        if pos is None:
+            f = open_alarmfile(fname)
+        else:
+            seek = Seek_index(seekfile_name(fname))
+            try:
+                f = seek.open(fname, pos)
+            finally:
+                seek.close()
+
+        modes = {}
+        with f:
+            for (owner, repo), it in read_alarmfile(f, store=store, magic=pos is None,
+                                                    starts=result['starts'], modes=modes):
+                name = '%s/%s' % (owner, repo)
+                r = verify_repo(it, select_depth(modes.get((owner, repo), 'all')))
+                r['repo'] = name
+                result['repos'].append(r)
+                name = None
+                if len(result['repos']) == count: break
+    except Exception as e:
+        # Whatever went wrong, the file is broken
+        where = ' in repository %s' % (name,) if name else ''
+        result['error'] = 'Error%s: %s (%s)' % (where, e, type(e).__name__)
+    finally:
+        if store is not None:
+            store.close()
+    return result
+
+# Combines the results of the tasks of one file and checks them against the index and seek index
+def verify_check_file(fname, results, idx):
+    dname = os.path.basename(fname)
+    not_found = 0
+    repos = [r for i in results for r in i['repos']]
+    errors = [i['error'] for i in results if i['error']]
+    names = [r['repo'] for r in repos]
+    
+    starts = []
+    for i in results:
+        starts += i['starts'][:len(i['repos'])]
+    end = results[-1]['starts'][-1] if not errors and results[-1]['starts'] else None
+
+    for r in repos:
+        if r['missing_trees'] or r['missing_parents']:
+            errors.append('Repository %s has %d missing trees and %d missing parents'
+                % (r['repo'], r['missing_trees'], r['missing_parents']))
+    if len(set(names)) != len(names):
+        errors.append('File contains repositories more than once')
+
+    if dname in idx.files:
+        size, offset = idx.files[dname]
+        if size != os.path.getsize(fname):
+            errors.append('Size of the file is %d, the index says %d' % (os.path.getsize(fname), size))
+        if end is not None and offset != end:
+            errors.append('Repositories end at offset %d, the index says %d' % (end, offset))
+        indexed = {'/'.join(i) for i, v in idx.repos.items() if v == dname}
+        if not errors and not set(names) <= indexed:
+            errors.append('%d repositories are missing from the index' % (len(set(names) - indexed),))
+        # acquire_metadata indexes repositories that were not found as well, so that they are not
+        # tried again. These are only counted.
+        not_found = len(indexed - set(names))
+    else:
+        errors.append('File is not in the index')
+
+    seek_fname = seekfile_name(fname)
+    if os.path.isfile(seek_fname) and not errors:
+        seek = Seek_index(seek_fname)
+        if seek.file_size == os.path.getsize(fname):
+            if ['%s/%s' % i for i in seek.repos] != names or list(map(int, seek.repo_pos)) != starts:
+                errors.append('Seek index %s does not match the file' % (seek_fname,))
+        seek.close()
+
+    return {'file': dname, 'ok': not errors, 'errors': errors, 'repos': len(repos),
+        'not_found': not_found,
+        'commits': sum(r['commits'] for r in repos), 'trees': sum(r['trees'] for r in repos),
+        'problems': [r for r in repos if r['missing_trees'] or r['missing_parents']]}
+
+def cmd_verify(outfile, *dnames):
+    import concurrent.futures
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+    idx = init_index()
+    store_path = os.path.join(options.data, options.store) if options.store else None
+    workers = options.threads or os.cpu_count() or 1
+
+    # Files with an up to date seek index are split into ranges of repositories, so that large
+    # files do not hold up the rest
+    tasks = {}
+    for fname in fnames:
+        seek_fname = seekfile_name(fname)
+        ranges = None
+        if os.path.isfile(seek_fname):
+            seek = Seek_index(seek_fname)
+            if seek.file_size == os.path.getsize(fname):
+                ranges = [(int(seek.repo_pos[a]), b - a if b < seek.num_repos else None)
+                    for a, b in seek.split(workers)]
+            seek.close()
+        tasks[fname] = ranges or [(None, None)]
+
+    print('Verifying %d files in %d parts, using %d processes...' % (len(fnames),
+        sum(len(i) for i in tasks.values()), workers))
+    report = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {fname: [pool.submit(verify_task, fname, store_path, pos, count)
+            for pos, count in ranges] for fname, ranges in tasks.items()}
+        for fname in fnames:
+            if global_stop_flag:
+                for i in futures.values():
+                    for j in i: j.cancel()
+                break
+            r = verify_check_file(fname, [i.result() for i in futures[fname]], idx)
+            report.append(r)
+            print('%s: %s (%d repositories, %d commits, %d trees%s)' % (r['file'],
+                'ok' if r['ok'] else 'ERROR', r['repos'], r['commits'], r['trees'],
+                ', %d not found' % (r['not_found'],) if r['not_found'] else ''))
+            for i in r['errors']:
+                print('  ' + i)
+
+    num_ok = sum(i['ok'] for i in report)
+    with open(outfile, 'w') as f:
+        f.write(json.dumps({'ok': num_ok, 'failed': len(report) - num_ok, 'files': report}, indent=4))
+    print('%d files are ok, %d have errors. Report written to %s' % (num_ok, len(report) - num_ok,
+        outfile))
+
+COMPACT_SCAN_SPAN = sys.maxsize # only record access points at the beginning of gzip members
+
+# Returns (repos, bounds, members): repository i is at bounds[i] to bounds[i+1] uncompressed,
+# members are the (out, in) offsets of the gzip members. Uses an up to date seek index.
+def compact_scan(fname):
+    with open(fname, 'rb') as f:
+        is_xz = f.read(len(XZ_MAGIC)) == XZ_MAGIC
+
+    seek_fname = seekfile_name(fname)
+    if not is_xz and os.path.isfile(seek_fname):
+        seek = Seek_index(seek_fname)
+        try:
+            if seek.file_size == os.path.getsize(fname):
+                members = [(int(seek.point_out[i]), int(seek.point_in[i]))
+                    for i in range(seek.num_items) if seek.point_bit[i] == ZRAN_MEMBER]
+                return list(seek.repos), list(map(int, seek.repo_pos)) + [seek.data_size], members
+        finally:
+            seek.close()
+
+    print('Reading %s...' % (fname,))
+    f = open_alarmfile(fname) if is_xz else Zran_reader(open(fname, 'rb'), span=COMPACT_SCAN_SPAN)
+    with f:
+        if f.read(4) != ALARMFILE_MAGIC:
+            raise Pack_error('%s is not an alarmfile' % (fname,))
+        starts = []
+        repos, offset = find_repos_and_offset(f, starts)
+        members = [] if is_xz else [(out, in_) for out, in_, _, _ in f.points]
+    return repos, [4 + i for i in starts] + [4 + offset], members
+
+# Compresses what is written with codec, copy appends complete gzip members as they are
+class Shard_writer:
+    def __init__(self, fname, codec):
+        self.f = open(fname, 'xb')
+        self.codec = codec
+        self.c = None
+        self.size = 0
+        self.copied = 0
+
+    def write(self, b):
+        if self.c is None:
+            self.c = Parallel_compressor(self.f, self.codec, options.threads, closefd=False)
+        self.size += len(b)
+        return self.c.write(b)
+
+    def _end_block(self):
+        if self.c is not None:
+            self.c.close()
+            self.c = None
+
+    def copy(self, fname, member_first, member_end, size):
+        self._end_block()
+        with open(fname, 'rb') as f:
+            f.seek(member_first[1])
+            copy_bytes(f, self.f, member_end[1] - member_first[1])
+        self.size += size
+        self.copied += size
+
+    def close(self):
+        self._end_block()
+        self.f.close()
+
+def compact_recompress(w, fname, members, begin, end):
+    # Start decompressing at the last member before begin, so that no window is needed
+    point = max((i for i in members if i[0] <= begin), default=None)
+    if point is None:
+        f = open_alarmfile(fname)
+        f.seek(begin)
+    else:
+        f = Zran_reader(open(fname, 'rb'), (point[0], point[1], ZRAN_MEMBER, b''))
+        f.skip(begin - point[0])
+    with f:
+        copy_bytes(f, w, end - begin)
+
+# Appends the uncompressed bytes begin to end of fname, copying the gzip members inside if do_copy
+def compact_segment(w, fname, members, begin, end, do_copy):
+    inner = [i for i in members if begin <= i[0] <= end]
+    if not do_copy or len(inner) < 2:
+        compact_recompress(w, fname, members, begin, end)
+        return
+    if begin < inner[0][0]:
+        compact_recompress(w, fname, members, begin, inner[0][0])
+    w.copy(fname, inner[0], inner[-1], inner[-1][0] - inner[0][0])
+    if inner[-1][0] < end:
+        compact_recompress(w, fname, members, inner[-1][0], end)
+
+def cmd_compact(prefix, *dnames):
+    data_dir = options.data
+
+    if not os.path.exists(data_dir):
+        die('The data directory (%s) does not exist!' % (data_dir,))
+
+    dnames = [i if i.endswith('.alarm.gz') else i + '.alarm.gz' for i in dnames]
+    fnames = sorted({j for i in dnames for j in glob.glob(os.path.join(data_dir, i))})
+    sources = {os.path.basename(i) for i in fnames}
+    idx = init_index()
+    codec = parse_codec(options.compress)
+    target = options.shard_size * 2**20
+
+    # Each shard is a list of repositories, and of segments (fname, members, begin, end) to copy
+    shards = []
+    seen = {}
+    size = 0
+    num_dropped = 0
+    for fname in fnames:
+        dname = os.path.basename(fname)
+        repos, bounds, members = compact_scan(fname)
+        ratio = os.path.getsize(fname) / max(bounds[-1], 1)
+        for i, repo in enumerate(repos):
+            # Among the files to compact, the first one wins
+            other = seen.get(repo, idx.repos.get(repo, dname))
+            if repo in seen or other not in sources:
+                print('Dropping repository %s from %s, it is already contained in %s' % (
+                    '/'.join(repo), dname, other))
+                num_dropped += 1
+                continue
+            seen[repo] = dname
+
+            # Cut on the estimated compressed size
+            repo_size = (bounds[i+1] - bounds[i]) * ratio
+            if not shards or (size and size + repo_size > target):
+                shards.append(([], []))
+                size = 0
+            size += repo_size
+            shard_repos, segments = shards[-1]
+            shard_repos.append(repo)
+            if segments and segments[-1][0] == fname and segments[-1][3] == bounds[i]:
+                segments[-1][3] = bounds[i+1]
+            else:
+                segments.append([fname, members, bounds[i], bounds[i+1]])
+
+    # acquire_metadata indexes repositories that were not found under the file it was writing, keep
+    # them so that they are not retried
+    missing = [repo for repo, dname in idx.repos.items() if dname in sources and repo not in seen]
+    if missing and not shards:
+        shards.append(([], []))
+
+    out_names = ['%s%d.alarm.gz' % (prefix, k) for k in range(len(shards))]
+    for i in out_names:
+        if os.path.exists(os.path.join(data_dir, i)) and i not in sources:
+            die('%s already exists, and is not one of the files to compact' % (i,))
+    print('Compacting %d files into %d, dropping %d repositories...' % (len(fnames), len(shards),
+        num_dropped))
+
+    # Nothing is changed until all shards have been written
+    written = []
+    data_sizes = []
+    try:
+        for dname, (shard_repos, segments) in zip(out_names, shards):
+            fname_tmp = os.path.join(data_dir, dname) + '.tmp'
+            if os.path.exists(fname_tmp):
+                os.remove(fname_tmp)
+            written.append(fname_tmp)
+            w = Shard_writer(fname_tmp, codec)
+            try:
+                w.write(ALARMFILE_MAGIC)
+                for fname, members, begin, end in segments:
+                    compact_segment(w, fname, members, begin, end, codec[0] == 'gzip')
+            finally:
+                w.close()
+            print('Wrote %s: %d repositories, %.1f MiB, %.0f%% copied without recompressing' % (
+                dname, len(shard_repos), os.path.getsize(fname_tmp) / 2**20,
+                w.copied / w.size * 100))
+            data_sizes.append(w.size)
+            if global_stop_flag:
+                raise KeyboardInterrupt()
+    except BaseException:
+        for i in written:
+            if os.path.exists(i):
+                os.remove(i)
+        print('Compaction aborted, no files were changed')
+        raise
+
+    for dname in out_names:
+        os.replace(os.path.join(data_dir, dname) + '.tmp', os.path.join(data_dir, dname))
+    idx.removefiles(sources)
+    shards[0][0].extend(missing)
+    for dname, (shard_repos, _), data_size in zip(out_names, shards, data_sizes):
+        idx.setfile(dname, os.path.getsize(os.path.join(data_dir, dname)), data_size, shard_repos)
+    save_index(idx)
+
+    # The seek indices, commitfiles and pathfiles of the old files are out of date
+    for dname in sources | set(out_names):
+        fname = os.path.join(data_dir, dname)
+        if dname not in out_names and os.path.exists(fname):
+            os.remove(fname)
+        for i in (seekfile_name(fname), commitfile_name(fname), pathfile_name(fname),
+                  treefile_name(fname)):
+            if os.path.exists(i):
+                os.remove(i)
+    print('Done.')
+
+# Only look at the beginning of the file, that should be representative enough
+BENCH_MAX_SIZE = 256 * 2**20
+
+def cmd_bench_codec(dname, *codecs):
+    data_dir = options.data
+
+    if not dname.endswith('.alarm.gz'):
+        print('Warning: %s does not end with .alarm.gz, adding it' % (dname,))
+        dname += '.alarm.gz'
+    fname = os.path.join(data_dir, dname)
+
+    if not os.path.isfile(fname):
+        die('%s does not exist or is not a file' % (fname,))
+
+    if not codecs:
+        codecs = ('gzip:1', 'gzip:5', 'gzip:7', 'gzip:9', 'lzma:0', 'lzma:6')
+    codecs = [(i, parse_codec(i)) for i in codecs]
+
+    with open_alarmfile(fname) as f:
+        data = f.read(BENCH_MAX_SIZE)
+
+    class Sink(io.BytesIO):
+        def close(self): pass
+
+    threads = options.threads or os.cpu_count() or 1
+    print('Read %.1f MiB from %s, using %d threads' % (len(data) / 2**20, fname, threads))
+    print('%-8s %8s %14s %14s' % ('codec', 'ratio', 'compress', 'decompress'))
+    for name, codec in codecs:
+        out = Sink()
+        time_start = time.perf_counter()
+        with Parallel_compressor(out, codec, threads) as f:
+            f.write(data)
+        time_comp = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        if codec[0] == 'gzip':
+            assert gzip.decompress(out.getvalue()) == data
+        else:
+            assert lzma.decompress(out.getvalue()) == data
+        time_decomp = time.perf_counter() - time_start
+
+        mib = len(data) / 2**20
+        print('%-8s %8.3f %9.1f MiB/s %9.1f MiB/s' % (name, len(out.getvalue()) / max(len(data), 1),
+            mib / time_comp, mib / time_decomp))
+
 class options:
     AT_LEAST_ONE = object()
     AT_MOST_ONE = object()
@@ -1197,6 +4900,25 @@ class options:
         'small_min':      ('m', int, 10000),
         'small_max':      ('M', int, 100000),
         'user_agent':     ('u', str, 'alarm/' + ALARM_VERSION),
+        'compress':       ('z', str, 'gzip:7'),
+        'threads':        ('j', int, 0),
+        'store':          ('s', str, ''),
+        'prefetch_batch': ('P', int, 100),
+        'negotiation_rounds': ('R', int, 1),
+        'seek_span':      ('N', int, 4),
+        'min_saving':     ('A', int, 64),
+        'spool':          ('S', str, ''),
+        'spool_max':      ('X', int, 10240),
+        'shard_size':     ('Z', int, 256),
+        'governor':       ('G', str, ''),
+        'max_rate':       ('W', int, 0),
+        'max_fetches':    ('K', int, 4),
+        'refs':           ('r', str, ''),
+        'profile':        ('p', str, ''),
+        'ledger':         ('L', str, ''),
+        'select':         ('O', str, 'all'),
+        'host_id':        ('H', str, ''),
+        'lease_time':     ('T', int, 300),
     }
     _commands = {
         'acquire': AT_LEAST_ONE,
@@ -1206,6 +4928,16 @@ class options:
         'genindex': 0,
         'list_contents': AT_LEAST_ONE,
         'graph_job': AT_LEAST_ONE,
+        'write_graphs': AT_LEAST_ONE,
+        'bench_codec': AT_LEAST_ONE,
+        'reparse': AT_LEAST_ONE,
+        'extract_commits': AT_LEAST_ONE,
+        'extract_paths': AT_LEAST_ONE,
+        'extract_trees': AT_LEAST_ONE,
+        'seekindex': AT_LEAST_ONE,
+        'daemon': 1,
+        'verify': AT_LEAST_ONE,
+        'compact': AT_LEAST_ONE,
     }
 
     @classmethod
@@ -1226,9 +4958,14 @@ class options:
     @classmethod
     def set(cls, name, val):
         setattr(cls, name, cls._arg_1[name][1](val))
+
+# Set the defaults, so that the functions can be used when importing this as a module
+options.init()
         
     
 def print_usage(f = sys.stdout):
+    import textwrap
+
     s = '''\
 Usage: ''' + sys.argv[0] + ''' [options...] command [args...]
         
@@ -1250,8 +4987,28 @@ wner>/<name> . Lines starting with a # will be ignored.
     Acquire the top100 repositories for the languages specified in the file <lst>, in the same way \
 as the command acquire.
 
-  small
-    Acquire small repositories into the data directory, in the same way as the command acquire.
+  small [<checkpoint>]
+    Acquire small repositories into the data directory, in the same way as the command acquire. The \
+search is split into queries by size and creation date, such that each has at most 1000 results \
+(the limit of the search API). The progress is recorded in the file <checkpoint> (relative to the \
+data directory, default: ''' + SMALL_CHECKPOINT_NAME + '''), so that an interrupted \
+search continues where it stopped. The repositories are written into files small_page<n>.alarm.gz .
+
+  daemon <queue>
+    Keep running, and acquire the repositories listed in files that are put into the directory \
+<queue>. Each file is a job, it should have the extension .lst and the same format as for \
+acquire_files. The repositories are written into <name>.alarm.gz, where <name> is the name of the \
+file, unless a line '#target <file>' says otherwise. Jobs with a line '#priority <n>' go first if \
+<n> is larger (default is 0), then smaller jobs go first. The state of each job is written into \
+<name>.status in <queue>, and the file is renamed to <name>.lst.done (or .failed) afterwards. \
+Index, API limits, connections and the like are kept in memory between jobs, so do not run \
+other commands acquiring into the same data directory at the same time.
+
+  reparse <target> [<repo> ...]
+    Write the repositories <repo> into <target>, in the same way as the command acquire, but take \
+the packs from the spool (see --spool) instead of downloading them. If no repositories are given, \
+all repositories in the spool are used. As with acquire, repositories that are already in the index \
+are skipped, so remove the old files first if you want to replace them.
 
   genindex
     Generate an index for the files in the data directory. If an index already exists, it is \
@@ -1262,9 +5019,63 @@ updated. This operation should not be necessary in normal operation.
 <owner>/<repo>, with one repository per line. <target> should be specified relative to the data \
 directory. They are interpreted as glob-like pattern.
 
+  write_graphs <file> <tag> [<tag> ...]
+    Write the commit graphs of all repositories that have each of the tags <tag> into the graphfile \
+<file>. Tags are taken from the classes directory, additionally each repository <owner>/<name> has \
+the tag repo_<owner>/<name>. Instead of a single tag, you can give <tag>,<tag>,... to select \
+repositories with at least one of the tags, and prefix it with ! to select repositories that do not \
+have it (remember to quote this in your shell). The format is described in the README.
+
+  extract_commits <target> [<target> ...]
+    Extract the metadata of all commits (author, committer, timestamps and timezones) in the files \
+<target> into columns, and write them into a commitfile next to each alarmfile, with the extension \
+.commits instead of .alarm.gz . Files that are up to date are skipped. <target> should be specified \
+relative to the data directory. They are interpreted as glob-like pattern.
+
+  extract_paths <target> [<target> ...]
+    Compute a Bloom filter of the paths each commit in the files <target> changes (compared to its \
+first parent), and write them into a pathfile next to each alarmfile, with the extension .paths \
+instead of .alarm.gz . Queries for the history of a path can then skip most commits without looking \
+at their trees. Files that are up to date are skipped. <target> should be specified relative to the \
+data directory. They are interpreted as glob-like pattern.
+
+  extract_trees <target> [<target> ...]
+    Extract the entries of all trees in the files <target> into columns of interned names, modes and \
+objects, and write them into a treefile next to each alarmfile, with the extension .trees instead \
+of .alarm.gz . Files that are up to date are skipped. <target> should be specified relative to the \
+data directory. They are interpreted as glob-like pattern.
+
+  seekindex <target> [<target> ...]
+    Build an index of access points for the files <target>, and write it next to each alarmfile, \
+with the extension .seek instead of .alarm.gz . This allows starting to read at any repository \
+without decompressing the file from the beginning, and works for existing files. Files that are up \
+to date are skipped. <target> should be specified relative to the data directory. They are \
+interpreted as glob-like pattern.
+
+  verify <file> <target> [<target> ...]
+    Check the files <target> for consistency: every object is parsed and hashed, each repository \
+must contain all trees and parents its commits and trees refer to, and the index (and seek index, if \
+any) must match the contents of the file. Files are checked in parallel (see --threads), and files \
+with a seek index are split across processes by repositories. A report in JSON format is written \
+into <file>. <target> should be specified relative to the data directory. They are interpreted as \
+glob-like pattern.
+
+  compact <prefix> <target> [<target> ...]
+    Merge or split the files <target> into new files <prefix>0.alarm.gz, <prefix>1.alarm.gz, ... of \
+about --shard-size each, and replace them in the index. Repositories that are contained more than \
+once, or that the index assigns to another file, are dropped. Complete gzip members are copied as \
+they are (using the seek index, if it is up to date), the rest is compressed as given by \
+--compress. Afterwards the files <target> are removed. <target> should be specified relative to \
+the data directory. They are interpreted as glob-like pattern.
+
   graph_job <file> <tag> [<tag> ...]
     Similar to write_graphs, but only writes a description of the operations to be performed into a file.
 
+  bench_codec <target> [<codec> ...]
+    Compress the beginning of the alarmfile <target> with each <codec> and print the compression \
+ratio and throughput. <target> should be specified relative to the data directory. Codecs are given \
+as for --compress. If no codecs are given, a selection of gzip and lzma levels is used.
+
 # Options
 
   ''' + options.describe('data') + '''
@@ -1273,7 +5084,8 @@ directory. They are interpreted as glob-like pattern.
   ''' + options.describe('classes') + '''
     Location of the classes directory. It may contain files that add tags to certain repositories. \
 Each file in that directory should have the same format as the files for acquire_files and the \
-name <tag>.lst . Then, <tag> will be considered a tag of each listed repository.
+name <tag>.lst . Then, <tag> will be considered a tag of each listed repository. The tags are \
+cached in the data directory, in the file ''' + TAG_CACHE_NAME + ''' .
 
   ''' + options.describe('index') + '''
     Name of the index file.
@@ -1284,9 +5096,82 @@ name <tag>.lst . Then, <tag> will be considered a tag of each listed repository.
   ''' + options.describe('files_max_refs') + '''
     Maximum number of refs to load when prefetching files.
 
+  ''' + options.describe('spool') + '''
+    Location of the spool directory, relative to the data directory. If given, the raw packs \
+received from the server are kept there, so that they can be parsed again without downloading them \
+(see reparse).
+
+  ''' + options.describe('spool_max') + '''
+    Maximum size of the spool directory (in MiB). If it grows larger, the least recently used packs \
+are removed.
+
+  ''' + options.describe('governor') + '''
+    Location of the state shared by all alarm processes on this host that limit their fetches \
+together, relative to the data directory (use an absolute path to share it between data \
+directories). If not given, there are no limits. Needs fcntl.
+
+  ''' + options.describe('max_rate') + '''
+    Total download bandwidth of the processes sharing the governor (in KiB/s). Each of them gets \
+its turn in order, so a large pack does not hold up the others. 0 means no limit.
+
+  ''' + options.describe('max_fetches') + '''
+    Number of packs the processes sharing the governor may negotiate and download from one server \
+at the same time.
+
+  ''' + options.describe('refs') + '''
+    Comma-separated glob patterns (e.g. refs/heads/*,refs/tags/*). If given, all advertised refs \
+that match are fetched in a single negotiation, and stored with the repository. Else only the \
+default branch is fetched.
+
+  ''' + options.describe('select') + '''
+    Objects to keep of each repository: all, commits (only the commits, e.g. for the commit graph) \
+or trees:<n> (the commits, and the trees less than <n> levels below their root trees, so trees:1 \
+keeps just the root trees). If the server supports partial clones, it leaves out the other trees, \
+else they are dropped while parsing the pack. The selection is stored with the repository.
+
+  ''' + options.describe('profile') + '''
+    Comma-separated profiling modes. timers measures the time spent in each stage of acquisition \
+(api, negotiate, network, inflate, patch_delta, hash, parse_commit, parse_tree, write, throttle, \
+...), cprofile additionally runs each repository under cProfile, and memory records its peak \
+memory usage with tracemalloc. At the end, the totals and the slowest and most memory-hungry \
+repositories are printed, and the full report is written to profile.json in the data directory.
+
+  ''' + options.describe('ledger') + '''
+    Location of the lease ledger, relative to the data directory, which lets several hosts acquire \
+into the same data directory on a shared filesystem. Before acquiring a repository, a host claims \
+it, so that each one is downloaded only once, and repositories that another host has acquired are \
+skipped. Each host writes into its own shards, <target>.<host>.alarm.gz, and merges its changes \
+into the index on disk whenever it is saved. If not given, there must be only one writer.
+
+  ''' + options.describe('host_id') + '''
+    Name of this host in the ledger and its shards. Processes sharing a ledger need distinct names, \
+also if they run on the same host. If not given, the hostname and the process id are used, so \
+each run writes into new shards (see compact to merge them).
+
+  ''' + options.describe('lease_time') + '''
+    Number of seconds after which the claims of a host that has stopped sending heartbeats (e.g. \
+because it crashed) expire, and other hosts may take them over. This must be well above the \
+difference between the clocks of the hosts.
+
+  ''' + options.describe('prefetch_batch') + '''
+    Number of repositories for which the tips of the refs are queried at once, using the GraphQL \
+API. This saves two API requests per ref and repository. Set to 0 to use only the REST API.
+
+  ''' + options.describe('min_saving') + '''
+    Minimum expected saving per API request (in KiB). The tree information of a repository is only \
+requested if the expected saving, based on its size and past acquisitions, is at least this much. \
+Set to 0 to always request it.
+
   ''' + options.describe('files_max_num') + '''
     Maximum number of prefetched files that will be passed to the server while negotiating packs. \
-(Bigger files are passed first.)
+(Bigger files are passed first.) Files that are too small to be worth the negotiation are left out, \
+based on how much bandwidth the haves saved in past acquisitions (kept in the data directory, in \
+the file ''' + PLANNER_STATE_NAME + ''').
+
+  ''' + options.describe('negotiation_rounds') + '''
+    Maximum number of requests to use for negotiating a pack. In each but the last, a batch of files \
+(starting at 256, doubling each round) is passed to the server, which tells us which of them it \
+has. Only those are repeated in later requests. 1 means that everything is sent in one request.
 
   ''' + options.describe('small_min') + '''
     Minimum size of a repository to be considered small (in KiB).
@@ -1297,6 +5182,31 @@ name <tag>.lst . Then, <tag> will be considered a tag of each listed repository.
   ''' + options.describe('user_agent') + '''
     String to send as user-agent in both API and pack-negotiation requests.
 
+  ''' + options.describe('compress') + '''
+    Codec to use when writing alarmfiles, either gzip:<level> (0-9) or lzma:<preset> (0-9). The \
+output is compressed in independent blocks, so the result is a regular multi-member gzip file (or \
+a sequence of xz streams). Files keep the .alarm.gz extension either way, the codec is detected when \
+reading.
+
+  ''' + options.describe('threads') + '''
+    Number of threads to use for compression, and of processes for verify. 0 means one per CPU.
+
+  ''' + options.describe('store') + '''
+    Location of the object store, relative to the data directory. If given, commits and trees are \
+stored only once in the object store, and alarmfiles only reference them by their hash. This saves \
+a lot of space for forks and mirrors. The same store has to be given when reading such alarmfiles. \
+When acquiring a fork whose parent is in the store, the tips of the parent are offered as haves, so \
+that the server only sends what the fork added. Only one process may add objects to a store at a \
+time, others stop with an error (reading is fine). So with --ledger, only one host can use --store.
+
+  ''' + options.describe('seek_span') + '''
+    Distance between access points in the index built by seekindex (in MiB of uncompressed data). \
+Each access point needs up to 32 KiB.
+
+  ''' + options.describe('shard_size') + '''
+    Size of the files written by compact (in MiB, estimated from the compression ratio of the \
+input files).
+
   --help,-h
     Print this help and exit.
 
@@ -1374,7 +5284,6 @@ def die(msg):
     sys.exit(3)
         
 def main():
-    options.init()
     signal.signal(signal.SIGINT, request_stop_handler)
     try:              
         cmd, cmd_args = parse_cmdline(sys.argv)
@@ -1385,10 +5294,21 @@ def main():
             'genindex':      cmd_genindex,
             'list_contents': cmd_list_contents,
             'graph_job':     cmd_graph_job,
+            'write_graphs':  cmd_write_graphs,
+            'bench_codec':   cmd_bench_codec,
+            'reparse':       cmd_reparse,
+            'extract_commits': cmd_extract_commits,
+            'extract_paths': cmd_extract_paths,
+            'extract_trees': cmd_extract_trees,
+            'seekindex':     cmd_seekindex,
+            'daemon':        cmd_daemon,
+            'verify':        cmd_verify,
+            'compact':       cmd_compact,
         }[cmd](*cmd_args)
     except Arg_parse_error as e:
         print('Error while parsing arguments:', str(e), file=sys.stderr)
         sys.exit(1)
 
 
-main()
+if __name__ == '__main__':
+    main()